@@ -0,0 +1,61 @@
+"""
+Bytes on the wire and CPU time per 1,000 records, at each gzip level:
+- influx write bodies (line protocol, as sent by InfluxConnector.add_samples)
+- GraphQL sleepRecords responses (JSON, as received by RESTClient when the server compresses them)
+
+Run from the repository root: python -m benchmarks.compression
+"""
+
+from datetime import timezone
+import gzip
+import json
+import time
+
+from benchmarks.line_protocol import sample_points
+from line_protocol import LineSerializer
+
+RECORDS = 1000
+LEVELS = (0, 1, 3, 6, 9)
+REPEAT = 20
+
+
+def cpu_ms(fn) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.process_time()
+        fn()
+        best = min(best, time.process_time() - start)
+    return best * 1000
+
+
+def report(name: str, body: bytes) -> None:
+    print(f"{name} ({RECORDS} records)")
+    print(f"  {'level':>5} {'bytes':>9} {'ratio':>6} {'compress ms':>12} {'decompress ms':>14}")
+    for level in LEVELS:
+        if not level:
+            print(f"  {'off':>5} {len(body):>9} {1:>6.2f} {0:>12.2f} {0:>14.2f}")
+            continue
+        compressed = gzip.compress(body, compresslevel=level, mtime=0)
+        print(
+            f"  {level:>5} {len(compressed):>9} {len(body) / len(compressed):>6.2f}"
+            f" {cpu_ms(lambda: gzip.compress(body, compresslevel=level, mtime=0)):>12.2f}"
+            f" {cpu_ms(lambda: gzip.decompress(compressed)):>14.2f}"
+        )
+
+
+def main() -> None:
+    points = sample_points(RECORDS)
+    lines = LineSerializer("cpap", points[0]["tags"], timezone.utc).lines(points)
+    report("influx write body", b"\n".join(lines))
+
+    patient_id = "0d6c1a8e-5b1b-4c43-9d0b-0f1c5f6f2a11"
+    items = [
+        {"startDate": point["time"], **point["fields"], "sleepRecordPatientId": patient_id, "__typename": "SleepRecord"}
+        for point in points
+    ]
+    response = {"data": {"getPatientWrapper": {"sleepRecords": {"items": items, "__typename": "SleepRecordConnection"}}}}
+    report("GraphQL sleepRecords response", json.dumps(response).encode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Decode throughput of GraphQL sleepRecords responses of 30, 365 and 3,650 nights:
+- aiohttp's json(): bytes decoded to a str, then the standard library
+- json_codec.loads on the bytes, with the standard library and with orjson (if installed)
+
+Run from the repository root: python -m benchmarks.json_decode
+"""
+
+import json
+import timeit
+
+from benchmarks.line_protocol import sample_points
+from myair_client import json_codec
+
+NIGHTS = (30, 365, 3650)
+REPEAT = 20
+
+
+def payload(nights: int) -> bytes:
+    items = [
+        {"startDate": point["time"], **point["fields"], "sleepRecordPatientId": "0d6c1a8e", "__typename": "SleepRecord"}
+        for point in sample_points(nights)
+    ]
+    response = {
+        "data": {
+            "getPatientWrapper": {
+                "patient": {"firstName": "Jane", "__typename": "Patient"},
+                "sleepRecords": {"items": items, "__typename": "SleepRecordConnection"},
+                "__typename": "PatientWrapper",
+            }
+        }
+    }
+    return json.dumps(response).encode("utf-8")
+
+
+def main() -> None:
+    decoders = {
+        "aiohttp json() (stdlib)": lambda body: json.loads(body.strip().decode("utf-8")),
+        "stdlib on bytes": json.loads,
+    }
+    if json_codec.orjson:
+        decoders["orjson on bytes"] = json_codec.orjson.loads
+    else:
+        print("orjson is not installed: only the standard library is measured")
+
+    print(f"  {'nights':>6} {'KiB':>6} {'decoder':<24} {'ms':>7} {'MiB/s':>8} {'nights/ms':>10}")
+    for nights in NIGHTS:
+        body = payload(nights)
+        for name, decode in decoders.items():
+            best = min(timeit.repeat(lambda: decode(body), number=1, repeat=REPEAT))
+            print(
+                f"  {nights:>6} {len(body) / 1024:>6.0f} {name:<24} {best * 1000:>7.3f}"
+                f" {len(body) / best / 1024 / 1024:>8.1f} {nights / best / 1000:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
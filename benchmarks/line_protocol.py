@@ -0,0 +1,73 @@
+"""
+Per-point cost of serializing sleep records to line protocol:
+the dicts handed to influxdb-client (as written before) versus line_protocol.LineSerializer,
+on point dicts and on a nights.NightBatch.
+
+Run from the repository root: python -m benchmarks.line_protocol
+"""
+
+from datetime import date, timedelta, timezone
+import random
+import timeit
+
+from influxdb_client import Point
+
+from line_protocol import LineSerializer
+from nights import NightBatch, series
+
+POINTS = 365
+REPEAT = 20
+
+
+def sample_points(count: int) -> list[dict]:
+    tags = {"serialNumber": "23201234567", "deviceType": "CPAP", "localizedName": "AirSense 11 AutoSet"}
+    first = date(2025, 1, 1)
+    return [
+        {
+            "measurement": "cpap",
+            "tags": tags,
+            "fields": {
+                "totalUsage": random.randint(0, 600),
+                "sleepScore": random.randint(0, 100),
+                "usageScore": random.randint(0, 70),
+                "ahiScore": random.randint(0, 5),
+                "maskScore": random.randint(0, 20),
+                "leakScore": random.randint(0, 20),
+                "ahi": round(random.uniform(0, 10), 1),
+                "maskPairCount": random.randint(0, 5),
+                "leakPercentile": round(random.uniform(0, 30), 1),
+            },
+            "time": (first + timedelta(days=i)).strftime("%Y-%m-%d"),
+        }
+        for i in range(count)
+    ]
+
+
+def main() -> None:
+    points = sample_points(POINTS)
+
+    def dict_path() -> bytes:
+        return "\n".join(Point.from_dict(point).to_line_protocol() for point in points).encode("utf-8")
+
+    def serializer_path() -> bytes:
+        # One serializer per device, as in Fleet
+        return b"\n".join(LineSerializer("cpap", points[0]["tags"], timezone.utc).lines(points))
+
+    batch = NightBatch(series("cpap", points[0]["tags"]))
+    for point in points:
+        batch.append(point["time"], point["fields"])
+
+    def batch_path() -> bytes:
+        return b"\n".join(LineSerializer("cpap", points[0]["tags"], timezone.utc).batch_lines(batch))
+
+    for name, fn in (
+        ("dict + influxdb-client", dict_path),
+        ("LineSerializer", serializer_path),
+        ("LineSerializer (batch)", batch_path),
+    ):
+        best = min(timeit.repeat(fn, number=1, repeat=REPEAT))
+        print(f"{name:<24} {best / POINTS * 1e6:8.2f} µs/point")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Memory (tracemalloc) held per night once a GraphQL sleepRecords response is decoded and converted,
+after the response itself is dropped:
+- sleep records: the decoded SleepRecord dicts
+- point dicts: {"measurement", "tags", "fields", "time"} as get_samples built them before
+- Night: one slotted object per night, with the interned Series
+- NightBatch: typed array columns, as get_samples builds them now
+
+Run from the repository root: python -m benchmarks.night_memory
+"""
+
+import gc
+import json
+import tracemalloc
+
+from benchmarks.line_protocol import sample_points
+from myair import NON_FIELD_KEYS
+from myair_client import json_codec
+from nights import Night, NightBatch, series
+
+NIGHTS = (31, 365, 3650)
+
+
+def payload(nights: int) -> bytes:
+    items = [
+        {"startDate": point["time"], **point["fields"], "sleepRecordPatientId": "0d6c1a8e", "__typename": "SleepRecord"}
+        for point in sample_points(nights)
+    ]
+    return json.dumps({"data": {"getPatientWrapper": {"sleepRecords": {"items": items}}}}).encode("utf-8")
+
+
+def records_of(body: bytes) -> list[dict]:
+    return json_codec.loads(body)["data"]["getPatientWrapper"]["sleepRecords"]["items"]
+
+
+def point_dicts(records: list[dict], tags: dict) -> list[dict]:
+    return [
+        {
+            "measurement": "cpap",
+            "tags": tags,
+            "fields": {k: v for k, v in record.items() if k not in NON_FIELD_KEYS},
+            "time": record["startDate"],
+        }
+        for record in records
+    ]
+
+
+def nights(records: list[dict], tags: dict) -> list[Night]:
+    night_series = series("cpap", tags)
+    return [Night(night_series, record["startDate"], record) for record in records]
+
+
+def night_batch(records: list[dict], tags: dict) -> NightBatch:
+    batch = NightBatch(series("cpap", tags))
+    for record in records:
+        batch.append(record["startDate"], record, NON_FIELD_KEYS)
+    return batch
+
+
+def bytes_held(body: bytes, convert) -> int:
+    """Memory still allocated once body is decoded and converted, and the decoded response is dropped"""
+    tags = {"serialNumber": "23201234567", "deviceType": "CPAP", "localizedName": "AirSense 11 AutoSet"}
+    gc.collect()
+    tracemalloc.start()
+    records = records_of(body)
+    converted = convert(records, tags)
+    del records
+    gc.collect()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del converted
+    return held
+
+
+def main() -> None:
+    representations = {
+        "sleep records": lambda records, tags: records,
+        "point dicts": point_dicts,
+        "Night": nights,
+        "NightBatch": night_batch,
+    }
+    print(f"  {'nights':>6} {'representation':<15} {'KiB':>8} {'bytes/night':>12}")
+    for count in NIGHTS:
+        body = payload(count)
+        for name, convert in representations.items():
+            held = bytes_held(body, convert)
+            print(f"  {count:>6} {name:<15} {held / 1024:>8.1f} {held / count:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
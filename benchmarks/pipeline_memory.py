@@ -0,0 +1,110 @@
+"""
+Peak memory (tracemalloc) of the sync of one account, from GraphQL responses to influx writes, for histories
+of 1, 3 and 10 years. The network and influx are simulated; everything in between is the real code.
+Fails (exit code 1) if the peak exceeds CEILING_MIB or grows with the length of the history.
+tests/test_pipeline_memory.py asserts the same.
+
+Run from the repository root: python -m benchmarks.pipeline_memory
+"""
+
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+import json
+import logging
+from pathlib import Path
+import re
+import sys
+import tomllib
+import tracemalloc
+
+from benchmarks.line_protocol import sample_points
+from fleet import Fleet
+from influx import InfluxWriter
+from myair_client import json_codec
+from myair_client.rest_client import RESTClient
+from state import StateStore
+
+YEARS = (1, 3, 10)
+CEILING_MIB = 2.0
+# Allowed growth of the peak between the shortest and the longest history
+GROWTH_FACTOR = 1.5
+
+DEVICE = {
+    "serialNumber": "23201234567",
+    "deviceType": "CPAP",
+    "lastSleepDataReportTime": "2026-10-17T07:12:00.000Z",
+    "localizedName": "AirSense 11 AutoSet",
+    "fgDeviceManufacturerName": "ResMed",
+    "fgDevicePatientId": "1",
+}
+
+
+class SimulatedClient(RESTClient):
+    """RESTClient answering GraphQL queries with generated nights, as JSON bytes like the real API"""
+
+    def __init__(self) -> None:
+        pass
+
+    async def connect(self, initial: bool | None = False) -> str:
+        return "SUCCESS"
+
+    async def close(self) -> None:
+        pass
+
+    async def _gql_query(self, operation_name: str, query: str, initial: bool | None = False) -> dict:
+        # A real request yields to the event loop (and its timers, e.g. the writer's flush) while waiting
+        await asyncio.sleep(0)
+        start, end = re.search(r'startMonth: "([\d-]+)", endMonth: "([\d-]+)"', query).groups()
+        first, last = date.fromisoformat(start), date.fromisoformat(end)
+        points = sample_points((last - first).days + 1)
+        items = [
+            {"startDate": (first + timedelta(days=i)).isoformat(), **point["fields"], "sleepRecordPatientId": "1"}
+            for i, point in enumerate(points)
+        ]
+        wrapper: dict = {"sleepRecords": {"items": items}}
+        if operation_name == "GetPatientDevicesAndSleepRecords":
+            wrapper["fgDevices"] = [DEVICE]
+        return json_codec.loads(json.dumps({"data": {"getPatientWrapper": wrapper}}).encode("utf-8"))
+
+
+async def sync_peak(years: int) -> float:
+    with open(Path(__file__).parent.parent / "template.config.toml", "rb") as f:
+        config = tomllib.load(f)
+    config["resmed"]["max_days"] = 365 * years
+    config["influx"]["spool_max_mb"] = 0
+    writer = InfluxWriter(config["influx"]["batch_size"], 0.01, 2)
+    state = StateStore(None)
+    fleet = Fleet(config, writer, None, state)
+    account = fleet.accounts[0]
+    account.my_air._session = type("Session", (), {"closed": False})()
+    account.my_air._client = SimulatedClient()
+    to_time = datetime.now(timezone.utc)
+    account.influx.get_last_recorded_time = lambda max_days, *args: to_time - timedelta(days=max_days)
+    account.influx.get_recorded_fields = lambda *args: []
+    account.influx.add_samples = lambda lines: None
+
+    tracemalloc.start()
+    try:
+        written, _ = await fleet.sync_account(account)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        await writer.close()
+        account.my_air._session = None
+        await fleet.close()
+        state.close()
+    print(f"  {years:>2} year(s): {written:>5} nights written, peak {peak / 1024 / 1024:.2f} MiB")
+    return peak / 1024 / 1024
+
+
+def main() -> None:
+    logging.getLogger().setLevel(logging.WARNING)
+    peaks = [asyncio.run(sync_peak(years)) for years in YEARS]
+    if max(peaks) > CEILING_MIB or peaks[-1] > peaks[0] * GROWTH_FACTOR:
+        print(f"FAILED: peak memory above {CEILING_MIB} MiB or growing with the history")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
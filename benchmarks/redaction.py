@@ -0,0 +1,110 @@
+"""
+CPU and memory allocated per sync cycle by the debug logging of a sleep records response
+(the response and the records are logged, as in RESTClient), at INFO and at DEBUG level:
+- before: eager f-string with the previous recursive, copy-everything redact_dict
+- after: lazy redacted() argument with the copy-on-write redact_dict
+
+Run from the repository root: python -m benchmarks.redaction
+"""
+
+from collections.abc import Mapping
+import logging
+import time
+import tracemalloc
+
+from benchmarks.line_protocol import sample_points
+from myair_client.helpers import REDACTED, redacted
+
+RECORDS = 10_000
+REPEAT = 5
+
+_LOGGER = logging.getLogger("benchmark")
+
+LEGACY_KEYS_TO_REDACT = [
+    "access_token", "Authorization", "email", "family_name", "firstName", "given_name,", "id_token", "lastName",
+    "login", "name", "password", "Password", "preferred_username", "sub", "token", "username", "Username",
+]
+
+
+def legacy_redact_dict(data):
+    """redact_dict as it was: recursive, copies every container, list scan per key"""
+    if not isinstance(data, (Mapping, list)):
+        return data
+    if isinstance(data, list):
+        return [legacy_redact_dict(val) for val in data]
+    redacted_data = {**data}
+    for key, value in redacted_data.items():
+        if value is None:
+            continue
+        if isinstance(value, str) and not value:
+            continue
+        if key in LEGACY_KEYS_TO_REDACT:
+            redacted_data[key] = REDACTED
+        elif isinstance(value, Mapping):
+            redacted_data[key] = legacy_redact_dict(value)
+        elif isinstance(value, list):
+            redacted_data[key] = [legacy_redact_dict(item) for item in value]
+    return redacted_data
+
+
+class FormatOnlyHandler(logging.Handler):
+    """Formats messages, as a real handler would, without writing them anywhere"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        record.getMessage()
+
+
+def response(count: int) -> dict:
+    items = [{"startDate": point["time"], **point["fields"], "__typename": "SleepRecord"} for point in sample_points(count)]
+    return {
+        "data": {
+            "getPatientWrapper": {
+                "patient": {"firstName": "Jane"},
+                "sleepRecords": {"items": items, "__typename": "SleepRecordConnection"},
+            }
+        }
+    }
+
+
+def before(records_dict: dict) -> None:
+    _LOGGER.debug(f"[get_sleep_records] records_dict: {legacy_redact_dict(records_dict)}")
+    records = records_dict["data"]["getPatientWrapper"]["sleepRecords"]["items"]
+    _LOGGER.debug(f"[get_sleep_records] records: {legacy_redact_dict(records)}")
+
+
+def after(records_dict: dict) -> None:
+    _LOGGER.debug("[get_sleep_records] records_dict: %s", redacted(records_dict))
+    records = records_dict["data"]["getPatientWrapper"]["sleepRecords"]["items"]
+    _LOGGER.debug("[get_sleep_records] records: %s", redacted(records))
+
+
+def measure(fn, records_dict: dict) -> tuple[float, float]:
+    """(best CPU ms, MiB allocated) of one cycle"""
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.process_time()
+        fn(records_dict)
+        best = min(best, time.process_time() - start)
+    tracemalloc.start()
+    fn(records_dict)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best * 1000, peak / 1024 / 1024
+
+
+def main() -> None:
+    records_dict = response(RECORDS)
+    _LOGGER.addHandler(FormatOnlyHandler())
+    _LOGGER.propagate = False
+
+    print(f"{RECORDS} sleep records, per cycle")
+    print(f"  {'level':<6} {'':<7} {'CPU ms':>9} {'peak MiB':>9}")
+    for level in (logging.INFO, logging.DEBUG):
+        _LOGGER.setLevel(level)
+        for name, fn in (("before", before), ("after", after)):
+            cpu, mib = measure(fn, records_dict)
+            print(f"  {logging.getLevelName(level):<6} {name:<7} {cpu:>9.2f} {mib:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -26,13 +26,29 @@ class Config:
         config = self.__load__(self._file)
         if config:
             for k, v in config.items():
+                # lists of tables (e.g. [[accounts]]) are taken as a whole
+                if isinstance(v, list):
+                    ret[k] = v
+                    continue
                 for kk, vv in v.items():
                     ret[k][kk] = vv
 
         # overwrite with environment variables, if exist
         for k, v in ret.items():
+            if isinstance(v, list):
+                continue
             for kk, vv in v.items():
                 key = f"{self._prefix}_{k}_{kk}".upper()
-                ret[k][kk] = os.environ.get(key, vv)
+                if key in os.environ:
+                    ret[k][kk] = self.__cast__(os.environ[key], vv)
 
         return ret
+
+    @staticmethod
+    def __cast__(value: str, template_value):
+        # environment variables are strings; give them the type of the setting they replace
+        if isinstance(template_value, bool):
+            return value.lower() in ("1", "true", "yes", "on")
+        if isinstance(template_value, (int, float)):
+            return type(template_value)(value)
+        return value
@@ -0,0 +1,280 @@
+import asyncio
+import contextlib
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
+import time
+from typing import NamedTuple
+
+import aiohttp
+
+from influx import LAST_TIME_FIELD, InfluxConnector, InfluxWriter
+from line_protocol import LineSerializer, get_timezone
+from myair import MyAirConnector, create_connector
+from myair_client.rate_limiter import HostRateLimiter
+from myair_client.rest_client import create_rate_limiter
+from myair_client.retry import RetryPolicy
+from myair_client.session_store import SessionStore, session_key
+from nights import NightBatch, Series
+from rolling import RollingStats, create_rolling_stats
+from state import DigestIndex, StateStore
+
+# When cross-checking the local state, first look for influx records this close to the last imported night
+CHECK_WINDOW_DAYS = 31
+
+
+class SyncStats(NamedTuple):
+    """Outcome of one sync of one account"""
+
+    name: str
+    ok: bool
+    written: int = 0
+    skipped: int = 0
+    seconds: float = 0
+    error: str | None = None
+    # lastSleepDataReportTime of the device after the sync
+    report_time: str | None = None
+
+
+def shard_of(login: str, count: int) -> int:
+    """Stable shard of an account: the same login lands on the same worker whatever the order of the accounts"""
+    return int(hashlib.sha256(login.lower().encode("utf-8")).hexdigest(), 16) % count
+
+
+def account_configs(config: dict) -> list[dict]:
+    """
+    One config per account: the [[accounts]] list if there is one, otherwise the single [resmed] account.
+    Each account inherits the [resmed] settings it does not override.
+    """
+    accounts = config.get("accounts", None) or [{}]
+    ret = []
+    for index, account in enumerate(accounts):
+        merged = {**config["resmed"], **account}
+        merged.setdefault("name", f"account {index + 1}" if len(accounts) > 1 else "resmed")
+        ret.append(merged)
+    return ret
+
+
+class Account:
+    def __init__(
+        self,
+        conf: dict,
+        influx_conf: dict,
+        store: SessionStore | None,
+        connector: aiohttp.BaseConnector,
+        limiter: HostRateLimiter,
+        retry: RetryPolicy,
+    ) -> None:
+        self.name: str = conf["name"]
+        self.conf: dict = conf
+        self.my_air = MyAirConnector(conf, store, connector, limiter, retry)
+        self.influx = InfluxConnector(
+            conf.get("bucket", None) or influx_conf["bucket"],
+            influx_conf["token"],
+            influx_conf["org"],
+            influx_conf["url"],
+            conf.get("measurement", None) or influx_conf["measurement"],
+            get_timezone(influx_conf["timezone"]),
+            influx_conf["gzip_level"],
+            influx_conf["gzip_min_bytes"],
+        )
+        self.key: str = session_key(self.my_air.config.username, self.my_air.config.region)
+        self._serializer: LineSerializer | None = None
+        self._series: Series | None = None
+
+    def serialize(self, nights: NightBatch) -> list[bytes]:
+        """Line protocol of nights of the account's device"""
+        if not nights:
+            return []
+        # Series are interned: the serializer is only built again when the device (or its tags) changes
+        if nights.series is not self._series:
+            self._serializer = LineSerializer(nights.series.measurement, nights.series.tags, self.influx.tz)
+            self._series = nights.series
+        return self._serializer.batch_lines(nights)
+
+
+class Fleet:
+    """
+    Syncs every configured account inside one event loop, at most max_concurrent_accounts at a time.
+    Accounts share one connection pool; a failing account does not hold back the others.
+    """
+
+    def __init__(
+        self, config: dict, writer: InfluxWriter, store: SessionStore | None, state: StateStore, shard: tuple[int, int] | None = None
+    ) -> None:
+        fleet_conf = config["fleet"]
+        self._writer = writer
+        self._state = state
+        self._digests = DigestIndex(state)
+        self._check_seconds: int = config["main"]["state_check_hours"] * 3600
+        self._semaphore = asyncio.Semaphore(max(1, fleet_conf["max_concurrent_accounts"]))
+        self._connector: aiohttp.BaseConnector = create_connector()
+        # Okta and AppSync throttle per client IP: pace all the accounts together
+        self._limiter: HostRateLimiter = create_rate_limiter(
+            fleet_conf["auth_requests_per_second"],
+            fleet_conf["graphql_requests_per_second"],
+            fleet_conf["max_inflight_per_host"],
+        )
+        # Shared so that a failing ResMed host is backed off by all the accounts at once
+        self._retry = RetryPolicy(fleet_conf["request_attempts"])
+        self._rolling: RollingStats | None = create_rolling_stats(config["influx"], get_timezone(config["influx"]["timezone"]))
+        confs = account_configs(config)
+        if shard:
+            index, count = shard
+            confs = [conf for conf in confs if shard_of(conf["login"], count) == index]
+        # Sync in progress per account, joined by concurrent requests to sync the same account
+        self._running: dict[str, asyncio.Task] = {}
+        self.accounts: list[Account] = [
+            Account(conf, config["influx"], store, self._connector, self._limiter, self._retry) for conf in confs
+        ]
+        for account in self.accounts:
+            writer.register(account.influx)
+        logging.info(f"Syncing {len(self.accounts)} account(s).")
+
+    async def close(self) -> None:
+        for account in self.accounts:
+            await account.my_air.close()
+            account.influx.close()
+        await self._connector.close()
+
+    async def sync_all(self, accounts: list[Account] | None = None) -> list[SyncStats]:
+        """Sync the given accounts (all by default); stats are in the same order as the accounts"""
+        accounts = self.accounts if accounts is None else accounts
+        stats: list[SyncStats] = await asyncio.gather(*[self.sync(account) for account in accounts])
+        failed = [s for s in stats if not s.ok]
+        logging.info(
+            f"Synced {len(stats) - len(failed)}/{len(stats)} account(s): "
+            f"{sum(s.written for s in stats)} point(s) written, {sum(s.skipped for s in stats)} unchanged."
+        )
+        for s in failed:
+            logging.warning(f"Sync of {s.name} failed: {s.error}")
+        return stats
+
+    async def sync(self, account: Account) -> SyncStats:
+        """Sync one account; concurrent calls for the same account (e.g. scheduled and triggered) share one sync"""
+        task = self._running.get(account.key)
+        if task is None:
+            task = asyncio.create_task(self.__sync(account))
+            self._running[account.key] = task
+            task.add_done_callback(lambda _: self._running.pop(account.key, None))
+        # A caller giving up (e.g. a trigger client disconnecting) does not cancel the sync for the others
+        return await asyncio.shield(task)
+
+    async def cancel(self) -> None:
+        """Cancel the syncs in progress (e.g. on stop): what they already queued is written when the writer is closed"""
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __sync(self, account: Account) -> SyncStats:
+        start = time.monotonic()
+        try:
+            written, skipped = await self.sync_account(account)
+        except Exception as e:
+            logging.exception(f"Unable to sync {account.name}")
+            return SyncStats(account.name, False, seconds=time.monotonic() - start, error=f"{e.__class__.__qualname__}: {e}")
+        device = account.my_air.device
+        report_time = device["lastSleepDataReportTime"] if device else None
+        return SyncStats(account.name, True, written, skipped, time.monotonic() - start, report_time=report_time)
+
+    async def sync_account(self, account: Account) -> tuple[int, int]:
+        # Writes of the points queued by __fetch
+        queued: list[asyncio.Future] = []
+        try:
+            async with self._semaphore:
+                checked, last_start_date, last_report_time, written, skipped = await self.__fetch(account, queued)
+        except asyncio.CancelledError:
+            # Stopping: the writer still writes what was queued on close, the nights are just not remembered
+            raise
+        except Exception:
+            # What was written survives a failure on a later month
+            await self.__commit(queued)
+            raise
+        # Wait for the points to be written without holding a slot: without a spool, a write waits for a full batch
+        # or for the flush interval, and the next accounts are fetched meanwhile
+        await self.__commit(queued)
+        if account.my_air.device:
+            self._state.update(account.key, account.my_air.device["serialNumber"], last_start_date, last_report_time, checked)
+        return written, skipped
+
+    async def __commit(self, queued: list[asyncio.Future]) -> None:
+        # Nights are remembered as their writes complete (see __queue); this only waits for the writes and reports failures
+        for done in queued:
+            await done
+
+    def __queue(self, account: Account, serial_number: str, nights: NightBatch, lines: list[bytes]) -> asyncio.Future:
+        """Queue the lines of nights for writing; the nights are remembered once written"""
+        done = self._writer.add(account.influx, lines)
+
+        def commit(future: asyncio.Future) -> None:
+            if not future.cancelled() and future.exception() is None:
+                self._digests.commit(serial_number, nights)
+
+        done.add_done_callback(commit)
+        return done
+
+    async def __fetch(self, account: Account, queued: list[asyncio.Future]) -> tuple[bool, str | None, str | None, int, int]:
+        """Fetch the account's new nights and queue them for writing; (checked, last_start_date, last_report_time, written, skipped)"""
+        my_air, influxConnector, state, digests, rolling = account.my_air, account.influx, self._state, self._digests, self._rolling
+        to_time = datetime.now(timezone.utc)
+        hwm = state.get(account.key)
+        last_report_time = hwm.last_report_time if hwm else None
+        last_start_date = hwm.last_start_date if hwm else None
+
+        # The local state replaces the (expensive) influx lookup, which now only runs
+        # on cold start and periodically to detect data lost on the influx side
+        checked = not hwm or not last_start_date or time.time() - hwm.checked_at >= self._check_seconds
+        if checked and last_start_date and self._writer.has_backlog(influxConnector):
+            # Influx is behind the spool: it would look like data was lost. Check once the spool is drained
+            checked = False
+        if checked:
+            since = StateStore.to_datetime(last_start_date) - timedelta(days=CHECK_WINDOW_DAYS) if last_start_date else None
+            influx_time = await asyncio.to_thread(
+                influxConnector.get_last_recorded_time,
+                account.conf["max_days"],
+                to_time,
+                hwm.serial_number if hwm else None,
+                since,
+            )
+            influx_date = influx_time.astimezone(influxConnector.tz).strftime("%Y-%m-%d")
+            if last_start_date and influx_date < last_start_date:
+                logging.warning(f"Influx is missing data imported up to {last_start_date}. Importing again from {influx_date}.")
+                last_report_time = None
+                digests.forget(hwm.serial_number)
+                if rolling:
+                    rolling.forget(hwm.serial_number)
+            last_start_date = influx_date
+            from_time = influx_time
+        else:
+            from_time = StateStore.to_datetime(last_start_date)
+
+        written, skipped = 0, 0
+        ret = await my_air.get_samples(last_report_time, from_time, to_time, influxConnector.measurement)
+        if ret:
+            serial_number = my_air.device["serialNumber"]
+            if not digests.is_loaded(serial_number):
+                # Nothing known locally about this device: learn what influx already has for these nights
+                nights = await asyncio.to_thread(influxConnector.get_recorded_fields, serial_number, my_air.since)
+                digests.seed(serial_number, nights)
+            seed_since = rolling.seed_since(serial_number, my_air.since) if rolling else None
+            if seed_since:
+                # The rolling windows of the first nights imported reach back to nights already in influx
+                nights = await asyncio.to_thread(influxConnector.get_recorded_fields, serial_number, seed_since)
+                rolling.seed(serial_number, seed_since, nights)
+            # Points are queued month by month as they are fetched: memory use does not grow with the length of the history
+            async with contextlib.aclosing(ret[1]) as chunks:
+                async for points in chunks:
+                    changed = digests.changed(serial_number, points)
+                    lines = account.serialize(changed)
+                    if rolling:
+                        lines += rolling.update(serial_number, points, changed)
+                    queued.append(self.__queue(account, serial_number, changed, lines))
+                    written, skipped = written + len(changed), skipped + len(points) - len(changed)
+                    # Only nights written with LAST_TIME_FIELD are seen by get_last_recorded_time when cross-checking
+                    last_start_date = max(changed.times_with(LAST_TIME_FIELD) + [last_start_date or ""]) or None
+            if rolling:
+                rolling.trim(serial_number)
+            logging.info(f"{account.name}: writing {written} point(s), skipped {skipped} unchanged.")
+            last_report_time = ret[0]
+        return checked, last_start_date, last_report_time, written, skipped
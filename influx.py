@@ -1,44 +1,448 @@
-from datetime import datetime, timedelta
-from influxdb_client import InfluxDBClient
+import asyncio
+import codecs
+import csv
+from datetime import datetime, timedelta, timezone, tzinfo
+import gzip
+import hashlib
+from influxdb_client import Dialect, InfluxDBClient, WritePrecision, WriteService
+from influxdb_client.client.exceptions import InfluxDBError
+from influxdb_client.client.util.date_utils import get_date_helper
 import logging
+import random
+import threading
+import time
+
+from line_protocol import night_timestamp
+from spool import Spool
+
+# A client idle for longer than this is pinged before being reused
+HEALTH_CHECK_SECONDS = 300
+# Field present in every sleep record, used to find the last one written
+LAST_TIME_FIELD = "totalUsage"
+# Influx rejected the points themselves: writing them again would fail the same way
+REJECTED_STATUSES = {400, 413, 422}
+# Delay before draining the spool again after influx was unavailable, doubled each time (capped)
+DRAIN_RETRY_SECONDS = 30
+MAX_DRAIN_RETRY_SECONDS = 600
+
+
+def flux_string(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class InfluxClientPool:
+    """
+    Long-lived InfluxDB clients, one per url/org/token, shared by all the connectors using them.
+    Used from asyncio.to_thread workers: get and discard are serialized by a lock.
+    """
+
+    def __init__(self) -> None:
+        self._clients: dict[tuple[str, str, str], InfluxDBClient] = {}
+        self._last_used: dict[tuple[str, str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, org: str, token: str) -> InfluxDBClient:
+        key = (url, org, token)
+        with self._lock:
+            client = self._clients.get(key, None)
+            now = time.monotonic()
+            if client and now - self._last_used[key] > HEALTH_CHECK_SECONDS and not client.ping():
+                logging.warning(f"Influx at {url} did not answer ping. Reconnecting.")
+                self.__discard(key, client)
+                client = None
+            if not client:
+                client = InfluxDBClient(url=url, token=token, org=org, debug=False)
+                self._clients[key] = client
+            self._last_used[key] = now
+            return client
+
+    def discard(self, url: str, org: str, token: str, client: InfluxDBClient | None = None) -> None:
+        """
+        Close the pooled client. With client, only if it is still the pooled one: threads that failed on the same
+        stale client do not close the fresh one another thread got in the meantime
+        """
+        with self._lock:
+            self.__discard((url, org, token), client)
+
+    def __discard(self, key: tuple[str, str, str], client: InfluxDBClient | None) -> None:
+        if client is not None and self._clients.get(key, None) is not client:
+            return
+        client = self._clients.pop(key, None)
+        self._last_used.pop(key, None)
+        if client:
+            client.close()
+
+    def close(self) -> None:
+        for url, org, token in list(self._clients):
+            self.discard(url, org, token)
+
+
+client_pool = InfluxClientPool()
 
 
 class InfluxConnector:
-    def __init__(self, bucket: str, token: str, org: str, url: str, measurement: str):
+    def __init__(
+        self,
+        bucket: str,
+        token: str,
+        org: str,
+        url: str,
+        measurement: str,
+        tz: tzinfo = timezone.utc,
+        gzip_level: int = 0,
+        gzip_min_bytes: int = 0,
+        pool: InfluxClientPool = client_pool,
+    ):
         self.bucket: str = bucket
         self.token: str = token
         self.org: str = org
         self.url: str = url
         self.measurement: str = measurement
+        # Nights are recorded at midnight in this time zone
+        self.tz: tzinfo = tz
+        # Write bodies of at least gzip_min_bytes are compressed at this level (1-9); 0 to never compress
+        self.gzip_level: int = gzip_level
+        self.gzip_min_bytes: int = gzip_min_bytes
+        self._pool: InfluxClientPool = pool
+
+    @property
+    def write_key(self) -> tuple[str, str, str, str]:
+        """Connectors with the same write_key can share write batches"""
+        return (self.url, self.org, self.token, self.bucket)
+
+    @property
+    def spool_key(self) -> str:
+        """Name of the spool folder of the bucket (no credentials in it)"""
+        return hashlib.sha256(f"{self.url}|{self.org}|{self.bucket}".encode("utf-8")).hexdigest()[:16]
 
     def __get_client(self) -> InfluxDBClient:
-        return InfluxDBClient(url=self.url, token=self.token, org=self.org, debug=False)
+        return self._pool.get(self.url, self.org, self.token)
 
-    def get_last_recorded_time(self, max_days: int, to_time: datetime) -> datetime:
-        query = f'from(bucket: "{self.bucket}") |> range(start: -{max_days}d) |> filter(fn: (r) => r._measurement == "{self.measurement}") |> last()'
-        result = self.__run_query(query)
-        results = list(result)
+    def __with_client(self, action):
+        # The pooled connection may have gone stale (influx restarted, idle socket dropped):
+        # retry once on a fresh client before giving up
+        client = self.__get_client()
+        try:
+            return action(client)
+        except InfluxDBError:
+            # influx answered: the connection is fine, let the caller decide
+            raise
+        except Exception as e:
+            logging.warning(f"Influx call failed, reconnecting. {e.__class__.__qualname__}: {e}")
+            self._pool.discard(self.url, self.org, self.token, client)
+        return action(self.__get_client())
 
-        if len(results) == 0:
+    def close(self) -> None:
+        self._pool.discard(self.url, self.org, self.token)
+
+    def get_last_recorded_time(self, max_days: int, to_time: datetime, serial_number: str = None, since: datetime = None) -> datetime:
+        """
+        Time of the most recent record, or to_time - max_days if there is none.
+        When the device serial number is known only its series are looked at, and when since is given
+        (e.g. the last imported night minus some margin) the lookup starts there before falling back to max_days.
+        """
+        floor = to_time - timedelta(days=max_days)
+        if since and since > floor:
+            last = self.__query_last_time(since, serial_number)
+            if last:
+                return last
+            logging.info(f"Found no records since {since:%Y-%m-%d}, looking back {max_days} day(s).")
+
+        last = self.__query_last_time(floor, serial_number)
+        if not last:
             logging.info(f"Found no records dated less than {max_days} days(s) in influx bucket {self.bucket} measurement {self.measurement}.")
-            return to_time - timedelta(days=max_days)
+            return floor
+        return last
+
+    def __query_last_time(self, start: datetime, serial_number: str = None) -> datetime | None:
+        # A single field (present in every record) is enough to know when the last night was written,
+        # and collapsing everything into one row keeps the result size constant as the history grows.
+        serial_filter = f' and r.serialNumber == "{flux_string(serial_number)}"' if serial_number else ""
+        query = (
+            f'from(bucket: "{flux_string(self.bucket)}")'
+            f' |> range(start: {start.astimezone(timezone.utc):%Y-%m-%dT%H:%M:%SZ})'
+            f' |> filter(fn: (r) => r._measurement == "{flux_string(self.measurement)}" and r._field == "{LAST_TIME_FIELD}"{serial_filter})'
+            ' |> last()'
+            ' |> keep(columns: ["_time"])'
+            ' |> group()'
+            ' |> sort(columns: ["_time"], desc: true)'
+            ' |> limit(n: 1)'
+        )
+        return self.__with_client(lambda client: self.__first_time(client, query))
+
+    @staticmethod
+    def __first_time(client: InfluxDBClient, query: str) -> datetime | None:
+        # Parse the raw CSV as it streams in and stop at the first data row,
+        # instead of building FluxTable/FluxRecord objects for the whole result
+        response = client.query_api().query_raw(query, dialect=Dialect(header=True, annotations=[]))
+        try:
+            header = None
+            for row in csv.reader(codecs.iterdecode(response, "utf-8")):
+                if not row:
+                    continue  # blank line between tables
+                if header is None:
+                    header = row
+                    continue
+                return get_date_helper().parse_date(row[header.index("_time")])
+            return None
+        finally:
+            response.close()
+
+    def get_recorded_fields(self, serial_number: str, since: datetime) -> list[tuple[str, dict]]:
+        """(startDate, fields) of each record of the device from the night of the given day"""
+        # Nights are stored at midnight in self.tz: east of UTC, the first one is the day before in UTC
+        start = datetime.fromtimestamp(night_timestamp(since.strftime("%Y-%m-%d"), self.tz), timezone.utc)
+        query = (
+            f'from(bucket: "{flux_string(self.bucket)}")'
+            f' |> range(start: {start:%Y-%m-%dT%H:%M:%SZ})'
+            f' |> filter(fn: (r) => r._measurement == "{flux_string(self.measurement)}" and r.serialNumber == "{flux_string(serial_number)}")'
+            # Only the fields: the tags (device ones and any account tags) would otherwise come back as columns
+            ' |> keep(columns: ["_time", "_field", "_value"])'
+            ' |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+        )
 
-        fluxtable = results[-1]
-        fluxrecord = fluxtable.records[-1]
-        fluxtime = fluxrecord.get_time()
+        def read(client: InfluxDBClient) -> list[tuple[str, dict]]:
+            ret = []
+            for record in client.query_api().query_stream(query):
+                fields = {
+                    k: v for k, v in record.values.items()
+                    if not k.startswith("_") and k not in ("result", "table") and v is not None
+                }
+                ret.append((record.get_time().astimezone(self.tz).strftime("%Y-%m-%d"), fields))
+            return ret
 
-        return fluxtime
+        return self.__with_client(read)
 
-    def add_samples(self, records: list) -> None:
-        if len(records) < 1:
+    def add_samples(self, lines: list[bytes]) -> None:
+        """Write points serialized by line_protocol.LineSerializer"""
+        if len(lines) < 1:
             return
 
-        logging.info(f"Importing {len(records)} record(s) to influx.")
-        with self.__get_client() as client:
-            with client.write_api() as write_api:
-                write_api.write(bucket=self.bucket, record=records)
+        logging.info(f"Importing {len(lines)} record(s) to influx.")
+        body = b"\n".join(lines)
+        headers = {"content_type": "text/plain; charset=utf-8"}
+        if self.gzip_level and len(body) >= self.gzip_min_bytes:
+            body = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+            headers["content_encoding"] = "gzip"
+        self.__with_client(
+            lambda client: WriteService(client.api_client).post_write(
+                org=self.org, bucket=self.bucket, body=body, precision=WritePrecision.S, **headers
+            )
+        )
+
+
+class InfluxWriter:
+    """
+    Buffers points from all the connectors and writes them in large batches, in the background:
+    - a batch is written when it reaches batch_size points, or flush_interval seconds after its first point
+    - at most max_inflight batches are being written at the same time
+    - throttling (429) and server errors (5xx) are retried with jittered exponential backoff,
+      waiting at least as long as influx' Retry-After header asks
+    - pending points are written on close()
+    With a spool, points are appended to it (on disk) instead of being buffered in memory, and write() returns once
+    they are there. A background task drains the spool into influx and, while influx is unavailable, keeps
+    trying again later: the points are never fetched again from myAir.
+    """
+
+    def __init__(
+        self, batch_size: int, flush_interval: float, max_inflight: int, max_retries: int = 5, spool: Spool | None = None
+    ):
+        self._batch_size: int = max(1, batch_size)
+        self._flush_interval: float = flush_interval
+        self._inflight = asyncio.Semaphore(max(1, max_inflight))
+        self._max_retries: int = max_retries
+        # Keyed by InfluxConnector.write_key, so that points of all the accounts writing to the same bucket share batches
+        self._connectors: dict[tuple, InfluxConnector] = {}
+        self._pending: dict[tuple, list] = {}
+        self._waiters: dict[tuple, list[asyncio.Future]] = {}
+        self._writes: set[asyncio.Task] = set()
+        self._timer: asyncio.TimerHandle = None
+        self._spool: Spool | None = spool
+        # Keyed by InfluxConnector.spool_key
+        self._spooled: dict[str, InfluxConnector] = {}
+        self._spooled_since_drain: int = 0
+        self._drain_now = asyncio.Event()
+        self._drain_lock = asyncio.Lock()
+        self._drainer: asyncio.Task | None = None
+        self._closing: bool = False
+
+    def add(self, connector: InfluxConnector, records: list[bytes]) -> asyncio.Future:
+        """Queue records (line protocol); the returned future completes once they are written (or failed for good)"""
+        if self._spool and records:
+            return asyncio.ensure_future(self.__append_to_spool(connector, records))
+        done = asyncio.get_running_loop().create_future()
+        if not records:
+            done.set_result(None)
+            return done
+
+        key = connector.write_key
+        self._connectors.setdefault(key, connector)
+        self._pending.setdefault(key, []).extend(records)
+        self._waiters.setdefault(key, []).append(done)
+        if len(self._pending[key]) >= self._batch_size:
+            self.__dispatch(key)
+        elif not self._timer:
+            self._timer = asyncio.get_running_loop().call_later(self._flush_interval, self.__dispatch_all)
+        return done
+
+    async def write(self, connector: InfluxConnector, records: list[bytes]) -> None:
+        await self.add(connector, records)
+
+    def register(self, connector: InfluxConnector) -> None:
+        """Let points spooled by a previous run for the connector's bucket be written"""
+        if self._spool:
+            self._spooled.setdefault(connector.spool_key, connector)
+            if self._spool.has_pending(connector.spool_key):
+                self.__start_drainer()
+
+    def has_backlog(self, connector: InfluxConnector) -> bool:
+        """Whether points of the connector's bucket are spooled, i.e. not in influx yet"""
+        return bool(self._spool and self._spool.has_pending(connector.spool_key))
+
+    async def flush(self) -> None:
+        self.__dispatch_all()
+        while self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        if self._spool:
+            await self.__drain()
+
+    async def close(self) -> None:
+        if self._pending:
+            logging.info(f"Flushing {sum(len(v) for v in self._pending.values())} pending point(s) to influx.")
+        if self._drainer:
+            # The flag stops the drainer even if the cancellation is lost (wait_for racing with the event)
+            self._closing = True
+            self._drainer.cancel()
+            await asyncio.gather(self._drainer, return_exceptions=True)
+            self._drainer = None
+        # Whatever cannot be written now stays in the spool for the next run
+        await self.flush()
+
+    async def __append_to_spool(self, connector: InfluxConnector, records: list[bytes]) -> None:
+        key = connector.spool_key
+        self._spooled.setdefault(key, connector)
+        await asyncio.to_thread(self._spool.append, key, records)
+        self._spooled_since_drain += len(records)
+        if self._spooled_since_drain >= self._batch_size:
+            self._drain_now.set()
+        self.__start_drainer()
+
+    def __start_drainer(self) -> None:
+        if not self._drainer:
+            self._drainer = asyncio.get_running_loop().create_task(self.__drain_forever())
+
+    async def __drain_forever(self) -> None:
+        retry_delay = DRAIN_RETRY_SECONDS
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._drain_now.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._closing:
+                return
+            self._drain_now.clear()
+            if await self.__drain():
+                retry_delay = DRAIN_RETRY_SECONDS
+                continue
+            logging.warning(f"Influx unavailable: keeping {self._spool.size / 1024:.0f} KiB of points spooled. Trying again in {retry_delay}s.")
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(MAX_DRAIN_RETRY_SECONDS, retry_delay * 2)
+
+    async def __drain(self) -> bool:
+        """Write the spooled points to influx; False if some could not be written"""
+        async with self._drain_lock:
+            self._spooled_since_drain = 0
+            await asyncio.to_thread(self._spool.seal)
+            results = await asyncio.gather(*[self.__drain_key(key) for key in self._spool.keys()])
+            return all(results)
+
+    async def __drain_key(self, key: str) -> bool:
+        connector = self._spooled.get(key, None)
+        if not connector:
+            # Spooled by a previous run: its connector is known once an account writes to the same bucket
+            return True
+        for segment in self._spool.segments(key):
+            lines = await asyncio.to_thread(self._spool.read, segment)
+            for start in range(0, len(lines), self._batch_size):
+                batch = lines[start:start + self._batch_size]
+                try:
+                    async with self._inflight:
+                        await self.__write_with_retries(connector, batch)
+                except InfluxDBError as e:
+                    if getattr(e, "status", None) not in REJECTED_STATUSES:
+                        return False
+                    logging.error(f"Influx bucket {connector.bucket} rejected {len(batch)} spooled point(s), dropping them. {e}")
+                except Exception:
+                    return False
+            await asyncio.to_thread(self._spool.remove, segment)
+        return True
+
+    def __dispatch_all(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        for key in list(self._pending):
+            self.__dispatch(key)
+
+    def __dispatch(self, key: tuple) -> None:
+        connector = self._connectors[key]
+        records = self._pending.pop(key, [])
+        waiters = self._waiters.pop(key, [])
+        if not self._pending and self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not records:
+            return
+        task = asyncio.get_running_loop().create_task(self.__write_all(connector, records, waiters))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def __write_all(self, connector: InfluxConnector, records: list, waiters: list[asyncio.Future]) -> None:
+        batches = [records[start:start + self._batch_size] for start in range(0, len(records), self._batch_size)]
+        errors = await asyncio.gather(*[self.__write_batch(connector, batch) for batch in batches])
+        error = next((e for e in errors if e), None)
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(None)
+
+    async def __write_batch(self, connector: InfluxConnector, batch: list) -> Exception | None:
+        try:
+            async with self._inflight:
+                await self.__write_with_retries(connector, batch)
+        except Exception as e:
+            logging.error(f"Dropping {len(batch)} point(s) for influx bucket {connector.bucket}. {e.__class__.__qualname__}: {e}")
+            return e
+        return None
+
+    async def __write_with_retries(self, connector: InfluxConnector, batch: list) -> None:
+        for attempt in range(self._max_retries + 1):
+            try:
+                await asyncio.to_thread(connector.add_samples, batch)
+                return
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt == self._max_retries:
+                    raise
+                logging.warning(f"Influx write failed ({e.__class__.__qualname__}), retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
 
-    def __run_query(self, query) -> None:
-        with self.__get_client() as client:
-            query_api = client.query_api()
-            return query_api.query(query)
+    @staticmethod
+    def retry_delay(error: Exception, attempt: int) -> float | None:
+        """Seconds to wait before retrying a write that failed with error, None if it should not be retried"""
+        if isinstance(error, InfluxDBError):
+            status = getattr(error, "status", None)
+            if status != 429 and not (status and status >= 500):
+                return None
+        # full jitter: anywhere between 0 and 2^attempt seconds, capped
+        delay = random.uniform(0, min(60, 2 ** attempt))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
@@ -0,0 +1,110 @@
+from datetime import datetime, timezone, tzinfo
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+# Fields of a sleep record, in the order they are written, with their influx type.
+# Scores are integers; ahi and leakPercentile are floats even when myAir sends a whole number,
+# so that a field never changes type in influx.
+FIELD_TYPES: dict[str, type] = {
+    "totalUsage": int,
+    "sleepScore": int,
+    "usageScore": int,
+    "ahiScore": int,
+    "maskScore": int,
+    "leakScore": int,
+    "ahi": float,
+    "maskPairCount": int,
+    "leakPercentile": float,
+}
+
+# Integer columns of a nights.NightBatch hold this where a night has no value (float columns hold NaN)
+MISSING_INT = -(2**63)
+
+_COLUMNS: tuple[tuple[str, type], ...] = tuple(FIELD_TYPES.items())
+_COLUMN_NAMES = frozenset(FIELD_TYPES)
+
+_KEY_ESCAPES = str.maketrans({",": "\\,", "=": "\\=", " ": "\\ ", "\n": "\\n", "\\": "\\\\"})
+_MEASUREMENT_ESCAPES = str.maketrans({",": "\\,", " ": "\\ ", "\n": "\\n", "\\": "\\\\"})
+_STRING_ESCAPES = str.maketrans({'"': '\\"', "\\": "\\\\", "\n": "\\n"})
+
+
+def escape_key(value: str) -> str:
+    return value.translate(_KEY_ESCAPES)
+
+
+def field_value(value, kind: type | None = None) -> str:
+    kind = kind or type(value)
+    if kind is bool:
+        return "true" if value else "false"
+    if kind is int:
+        return f"{int(value)}i"
+    if kind is float:
+        return repr(float(value))
+    return f'"{str(value).translate(_STRING_ESCAPES)}"'
+
+
+@lru_cache(maxsize=512)
+def night_timestamp(start_date: str, tz: tzinfo) -> int:
+    """Epoch seconds of midnight of the startDate (%Y-%m-%d) in the given time zone"""
+    return int(datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=tz).timestamp())
+
+
+class LineSerializer:
+    """
+    Line protocol (at second precision) of the points of one series: the measurement and tag set are escaped once,
+    the fields are written in FIELD_TYPES order (other fields after them, by name).
+    A point without any field is not valid line protocol: line() returns b"" for it and lines() skip it.
+    """
+
+    def __init__(self, measurement: str, tags: dict[str, str], tz: tzinfo) -> None:
+        tag_set = "".join(f",{escape_key(k)}={escape_key(str(v))}" for k, v in sorted(tags.items()) if v not in (None, ""))
+        self._prefix: str = measurement.translate(_MEASUREMENT_ESCAPES) + tag_set + " "
+        self._tz: tzinfo = tz
+
+    def line(self, point: dict) -> bytes:
+        fields = point["fields"]
+        parts = []
+        for name, kind in _COLUMNS:
+            value = fields.get(name)
+            if value is None:
+                continue
+            parts.append(f"{name}={int(value)}i" if kind is int else f"{name}={float(value)!r}")
+        if not fields.keys() <= _COLUMN_NAMES:
+            parts.extend(
+                f"{escape_key(k)}={field_value(v)}" for k, v in sorted(fields.items()) if k not in FIELD_TYPES and v is not None
+            )
+        if not parts:
+            return b""
+        return f"{self._prefix}{','.join(parts)} {night_timestamp(point['time'], self._tz)}".encode("utf-8")
+
+    def lines(self, points: list[dict]) -> list[bytes]:
+        return [line for line in map(self.line, points) if line]
+
+    def batch_lines(self, batch) -> list[bytes]:
+        """Line protocol of the nights of a nights.NightBatch, read straight from its columns"""
+        columns = [(f"{name}=", kind is int, column) for (name, kind), column in zip(_COLUMNS, batch.columns)]
+        ret = []
+        for index, time in enumerate(batch.times):
+            parts = []
+            for prefix, is_int, column in columns:
+                value = column[index]
+                if is_int:
+                    if value != MISSING_INT:
+                        parts.append(f"{prefix}{value}i")
+                elif value == value:
+                    parts.append(f"{prefix}{value!r}")
+            extra = batch.extra.get(index)
+            if extra:
+                parts.extend(f"{escape_key(k)}={field_value(v)}" for k, v in sorted(extra.items()) if v is not None)
+            if not parts:
+                # Influx would reject the whole batch, as influxdb-client's Point skipped such a night
+                continue
+            ret.append(f"{self._prefix}{','.join(parts)} {night_timestamp(time, self._tz)}".encode("utf-8"))
+        return ret
+
+
+@lru_cache(maxsize=64)
+def get_timezone(name: str) -> tzinfo:
+    # UTC does not need the time zone database (not part of slim images, see tzdata in requirements.txt)
+    return ZoneInfo(name) if name and name.upper() != "UTC" else timezone.utc
+
@@ -1,18 +1,25 @@
 import asyncio
-from datetime import datetime, timezone
+from collections.abc import Awaitable
 import logging
+from pathlib import Path
 import platform
+import signal
 import sys
 import time
 
 from config import Config
-from influx import InfluxConnector
-from myair import MyAirConnector
+from fleet import Fleet, SyncStats
+from influx import InfluxWriter
+from myair_client.session_store import create_session_store
+from scheduler import PollScheduler
+from spool import Spool
+from state import StateStore
+from storage import FILE_MODE, connect_shared_sqlite
+from supervisor import Supervisor
+from trigger import TriggerServer
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-last_report_time: str = None
-
 SUPPORTED_PYTHON_MAJOR = 3
 SUPPORTED_PYTHON_MINOR = 11
 
@@ -21,47 +28,159 @@ if sys.version_info < (SUPPORTED_PYTHON_MAJOR, SUPPORTED_PYTHON_MINOR):
         f"Python version {SUPPORTED_PYTHON_MAJOR}.{SUPPORTED_PYTHON_MINOR} or later required. Current version: {platform.python_version()}."
     )
 
-try:
-    config = Config("config.toml", "myair_influx").load()
+
+def install_stop_handlers(stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            # Windows event loops do not support signal handlers; Ctrl-C still raises KeyboardInterrupt
+            pass
+
+
+def get_data_dir(main_conf: dict) -> Path | None:
+    if not main_conf["data_dir"]:
+        return None
+    # Relative paths are relative to the app folder, same as the config files; absolute paths are kept as is
+    return Path(__file__).parent / main_conf["data_dir"]
+
+
+async def run(config: dict[str, dict], shard: tuple[int, int] | None = None) -> None:
     main_conf = config["main"]
-    logging.getLogger().setLevel(logging.getLevelName(main_conf["logverbosity"]))
-    sleep_time = main_conf["loop_minutes"] * 60
-    logging.debug(f"CONFIG: {config}")
+    data_dir = get_data_dir(main_conf)
 
-    my_air_conf = config["resmed"]
-    my_air = MyAirConnector(my_air_conf)
     influx_conf = config["influx"]
-    influxConnector = InfluxConnector(
-        influx_conf["bucket"],
-        influx_conf["token"],
-        influx_conf["org"],
-        influx_conf["url"],
-        influx_conf["measurement"],
+    spool = None
+    if data_dir and influx_conf["spool_max_mb"]:
+        # One spool per worker process
+        spool = Spool(data_dir / "spool" / str(shard[0] if shard else 0), influx_conf["spool_max_mb"] * 1024 * 1024)
+    writer = InfluxWriter(
+        influx_conf["batch_size"],
+        influx_conf["flush_interval_seconds"],
+        influx_conf["max_inflight_batches"],
+        spool=spool,
     )
 
-    while True:
-        try:
-            to_time = datetime.now(timezone.utc)
-            from_time = influxConnector.get_last_recorded_time(
-                my_air_conf["max_days"], to_time
-            )
-
-            ret = asyncio.run(
-                my_air.get_samples(
-                    last_report_time, from_time, to_time, influxConnector.measurement
-                )
-            )
-            if ret:
-                influxConnector.add_samples(ret[1])
-                last_report_time = ret[0]
-        except Exception as e:
-            logging.exception(e)
+    stop = asyncio.Event()
+    install_stop_handlers(stop)
+
+    session_store = create_session_store(config["resmed"]["session_store"], data_dir, FILE_MODE, connect_shared_sqlite)
+    state = StateStore(data_dir)
+    fleet = Fleet(config, writer, session_store, state, shard)
+
+    trigger = None
+    if main_conf["trigger_port"]:
+        # Each worker process listens on its own port
+        port = main_conf["trigger_port"] + (shard[0] if shard else 0)
+        trigger = TriggerServer(fleet, main_conf["trigger_host"], port, main_conf["trigger_token"] or None)
+
+    try:
+        if trigger:
+            await trigger.start()
+        await sync_loop(fleet, main_conf, state, stop)
+    finally:
+        if trigger:
+            await trigger.close()
+        # Whatever is still buffered gets written before exiting, e.g. on docker stop
+        await writer.close()
+        await fleet.close()
+        state.close()
+
+    logging.info("Stopped.")
+
+
+async def sync_loop(fleet: Fleet, main_conf: dict, state: StateStore, stop: asyncio.Event) -> None:
+    sleep_time = main_conf["loop_minutes"] * 60
+
+    if sleep_time and main_conf["adaptive_polling"]:
+        await adaptive_sync_loop(fleet, main_conf["min_poll_minutes"] * 60, sleep_time, state, stop)
+        return
+
+    while not stop.is_set():
+        await until_stopped(fleet, fleet.sync_all(), stop)
 
         if not sleep_time:
-            exit(0)
+            break
+        for account in fleet.accounts:
+            account.my_air.set_next_poll(time.time() + sleep_time)
+
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=sleep_time)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def until_stopped(fleet: Fleet, cycle: Awaitable[list[SyncStats]], stop: asyncio.Event) -> list[SyncStats] | None:
+    """
+    Run a sync cycle, or cancel it when stop is set (e.g. docker stop only waits a few seconds):
+    None if it was cancelled. What the cancelled syncs already fetched is written when the writer is closed
+    """
+    cycle_task = asyncio.ensure_future(cycle)
+    stop_task = asyncio.ensure_future(stop.wait())
+    await asyncio.wait({cycle_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+    stop_task.cancel()
+    if cycle_task.done():
+        return cycle_task.result()
+    logging.info("Stopping: cancelling the syncs in progress.")
+    await fleet.cancel()
+    cycle_task.cancel()
+    await asyncio.gather(cycle_task, return_exceptions=True)
+    return None
+
+
+async def adaptive_sync_loop(
+    fleet: Fleet, min_interval: float, max_interval: float, state: StateStore, stop: asyncio.Event
+) -> None:
+    scheduler = PollScheduler(state, min_interval, max_interval)
+    scheduler.start([account.key for account in fleet.accounts])
+
+    while not stop.is_set():
+        due = set(scheduler.due())
+        if due:
+            accounts = [account for account in fleet.accounts if account.key in due]
+            for account, stats in zip(accounts, await until_stopped(fleet, fleet.sync_all(accounts), stop) or []):
+                wait = scheduler.done(account.key, stats.report_time, stats.ok)
+                account.my_air.set_next_poll(time.time() + wait)
+
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=max(0, scheduler.next_poll() - time.time()))
+        except asyncio.TimeoutError:
+            pass
+
+
+def load_config() -> dict[str, dict]:
+    return Config("config.toml", "myair_influx").load()
+
+
+def set_log_level(config: dict[str, dict]) -> None:
+    logging.getLogger().setLevel(logging.getLevelName(config["main"]["logverbosity"]))
+
+
+def worker(config: dict[str, dict], shard: tuple[int, int]) -> None:
+    """Entry point of a worker process started by the Supervisor"""
+    logging.basicConfig(format="%(processName)s %(levelname)s: %(message)s", level=logging.INFO, force=True)
+    set_log_level(config)
+    try:
+        asyncio.run(run(config, shard))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    try:
+        config = load_config()
+        set_log_level(config)
+        logging.debug(f"CONFIG: {config}")
 
-        time.sleep(sleep_time)
+        workers = config["fleet"]["workers"]
+        if workers > 1:
+            Supervisor(load_config, worker, workers).run()
+        else:
+            asyncio.run(run(config))
 
-except Exception as e:
-    logging.exception(e)
-    exit(1)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logging.exception(e)
+        exit(1)
@@ -1,64 +1,171 @@
 import aiohttp
-from asyncio.proactor_events import _ProactorBasePipeTransport
-from datetime import datetime
-from functools import wraps
+from collections.abc import AsyncIterator
+from datetime import datetime, timedelta
 import logging
-from myair_client.myair_client import MyAirConfig
+import ssl
+from myair_client.myair_client import MyAirConfig, SleepRecord
 from myair_client import get_client
+from myair_client import json_codec
+from myair_client.rate_limiter import HostRateLimiter
+from myair_client.retry import RetryPolicy
+from myair_client.session_store import SessionStore
+from nights import NightBatch, Series, series
 
-# Code copied from
-# https://pythonalgos.com/runtimeerror-event-loop-is-closed-asyncio-fix
-"""fix yelling at me error"""
+# Device attributes written as tags of each point
+TAG_KEYS = {'serialNumber', 'deviceType', 'localizedName'}
+# Sleep record attributes that are not written as fields
+NON_FIELD_KEYS = {'startDate', '__typename', 'sleepRecordPatientId'}
 
-
-def silence_event_loop_closed(func):
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except RuntimeError as e:
-            if str(e) != 'Event loop is closed':
-                raise
-    return wrapper
+# Resolved Okta / AppSync addresses rarely change; keep them for the life of a few cycles
+DNS_CACHE_SECONDS = 3600
+# Keep idle connections open between cycles so steady-state requests skip the TCP/TLS handshakes
+KEEPALIVE_SECONDS = 300
 
 
-_ProactorBasePipeTransport.__del__ = silence_event_loop_closed(_ProactorBasePipeTransport.__del__)
-"""fix yelling at me error end"""
+def create_connector() -> aiohttp.TCPConnector:
+    # A single SSL context lets the connector reuse its TLS sessions across connections
+    return aiohttp.TCPConnector(
+        ssl=ssl.create_default_context(),
+        ttl_dns_cache=DNS_CACHE_SECONDS,
+        keepalive_timeout=KEEPALIVE_SECONDS,
+        limit_per_host=10,
+    )
 
 
 class MyAirConnector:
 
-    def __init__(self, config: dict[str, str]):
+    def __init__(
+        self,
+        config: dict[str, str],
+        store: SessionStore | None = None,
+        connector: aiohttp.BaseConnector | None = None,
+        limiter: HostRateLimiter | None = None,
+        retry: RetryPolicy | None = None,
+    ):
         self.config = MyAirConfig(username=config["login"], password=config["password"], region=config["region"])
+        # Extra tags added to every point of this account
+        self._tags: dict[str, str] = config.get("tags", None) or {}
+        # Connection pool shared with other accounts; owned by the caller
+        self._connector: aiohttp.BaseConnector | None = connector
+        self._limiter: HostRateLimiter | None = limiter
+        self._retry: RetryPolicy | None = retry
+        # Applies to each request (the aiohttp default only bounds the whole request at 5 minutes)
+        self._timeout = aiohttp.ClientTimeout(
+            total=config["request_timeout_seconds"], sock_connect=min(10, config["request_timeout_seconds"])
+        )
+        self._month_concurrency: int = config["month_concurrency"]
+        self._late_arrival_days: int = config["late_arrival_days"]
+        self._store = store
+        self._session: aiohttp.ClientSession = None
+        self._client = None
+        # Epoch seconds of the next scheduled sync of the account, if known
+        self._next_poll: float | None = None
+        # Device returned by the last call to get_samples, and first night it requested
+        self.device: dict = None
+        self.since: datetime = None
+
+    async def __aenter__(self) -> "MyAirConnector":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        # One session (and one logged-in client) for the life of the process:
+        # tokens and cookies survive between cycles so connect() can skip the Okta login.
+        if self._session and not self._session.closed:
+            return
+        if self._connector:
+            self._session = aiohttp.ClientSession(
+                connector=self._connector, connector_owner=False, timeout=self._timeout, json_serialize=json_codec.dumps
+            )
+        else:
+            self._session = aiohttp.ClientSession(
+                connector=create_connector(), timeout=self._timeout, json_serialize=json_codec.dumps
+            )
+        self._client = get_client(self.config, self._session, self._store, self._limiter, self._retry)
+        self._client.set_next_use(self._next_poll)
+
+    def set_next_poll(self, when: float | None) -> None:
+        """Epoch seconds of the account's next scheduled sync: the access token is only renewed ahead of it"""
+        self._next_poll = when
+        if self._client:
+            self._client.set_next_use(when)
+
+    async def close(self) -> None:
+        if self._client:
+            await self._client.close()
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._client = None
 
-    async def get_samples(self, last_report_time: str, from_time: datetime, to_time: datetime, measurement: str) -> list:
+    def plan_window(self, last_night: datetime, to_time: datetime) -> datetime:
+        """
+        First night worth importing, given the last night already written:
+        myAir keeps revising the scores of a night for a few days after it is uploaded,
+        so the last late_arrival_days nights are imported again, older ones are not.
+        The API returns whole months, so the request covers the months from that night to to_time.
+        """
+        since = min(last_night, to_time) - timedelta(days=self._late_arrival_days)
+        since = since.replace(hour=0, minute=0, second=0, microsecond=0)
+        months = (to_time.year - since.year) * 12 + to_time.month - since.month + 1
+        logging.info(
+            f"Fetching {months} month(s) from {since:%Y-%m}, expecting to skip up to {since.day - 1} night(s) already imported."
+        )
+        return since
+
+    async def get_samples(
+        self, last_report_time: str, from_time: datetime, to_time: datetime, measurement: str
+    ) -> list | None:
+        """
+        [lastSleepDataReportTime, points], or None when the device did not report anything new.
+        The points come as an async iterator of NightBatch (one per month fetched), built as the records arrive:
+        a long history is never held in memory at once.
+        """
         try:
-            client_session = aiohttp.ClientSession()
-            client = get_client(self.config, client_session)
+            await self.open()
+            client = self._client
             await client.connect()
-            device = await client.get_user_device_data()
+            since = self.plan_window(from_time, to_time)
+            self.since = since
+            # Device and sleep records in one round trip; the records are None when the device reported nothing new
+            device, sleep_records = await client.get_device_and_sleep_records(
+                since, to_time, self._month_concurrency, last_report_time
+            )
+            self.device = device
             current_report_time = device['lastSleepDataReportTime']
-            if last_report_time and last_report_time == current_report_time:
-                await client_session.close()
+            if sleep_records is None:
                 logging.info("No new data to import.")
                 return None
 
             logging.info(f"Device last reported data on: {current_report_time}")
-            tags = {k: v for k, v in device.items() if k in {'serialNumber', 'deviceType', 'localizedName'}}
-
-            sleep_records = await client.get_sleep_records(from_time, to_time)
-
-            ret = []
-            for record in sleep_records:
-                fields = {k: v for k, v in record.items() if k not in {'startDate', '__typename', 'sleepRecordPatientId'}}
-                time = record["startDate"]
-                logging.info(f"Record date: {time}")
-                ret.append({"measurement": measurement, "tags": tags, "fields": fields, "time": time})
-
-            await client_session.close()
+            tags = {**self._tags, **{k: v for k, v in device.items() if k in TAG_KEYS}}
+            return [current_report_time, self.__points(sleep_records, since, series(measurement, tags))]
 
-            return [current_report_time, ret]
+        except Exception:
+            logging.exception("Unable to get myair data")
+            raise
 
-        except:
+    async def __points(
+        self, sleep_records: AsyncIterator[list[SleepRecord]], since: datetime, night_series: Series
+    ) -> AsyncIterator[NightBatch]:
+        first_night = since.strftime("%Y-%m-%d")
+        nights, imported = 0, 0
+        try:
+            async for records in sleep_records:
+                ret = NightBatch(night_series)
+                for record in records:
+                    if record["startDate"] < first_night:
+                        continue
+                    time = record["startDate"]
+                    logging.info(f"Record date: {time}")
+                    ret.append(time, record, NON_FIELD_KEYS)
+                nights += len(records)
+                imported += len(ret)
+                yield ret
+        except Exception:
             logging.exception("Unable to get myair data")
             raise
+        logging.info(f"Got {nights} night(s), skipped {nights - imported} already imported.")
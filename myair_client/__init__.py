@@ -1,9 +1,18 @@
 from aiohttp import ClientSession
 
 from .myair_client import MyAirConfig
+from .rate_limiter import HostRateLimiter
 from .rest_client import RESTClient
+from .retry import RetryPolicy
+from .session_store import SessionStore
 
 
 # May be able to remove this entire file and just use RESTClient directly
-def get_client(config: MyAirConfig, session: ClientSession):
-    return RESTClient(config, session)
+def get_client(
+    config: MyAirConfig,
+    session: ClientSession,
+    store: SessionStore | None = None,
+    limiter: HostRateLimiter | None = None,
+    retry: RetryPolicy | None = None,
+):
+    return RESTClient(config, session, store, limiter, retry)
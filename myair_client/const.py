@@ -16,13 +16,13 @@ CONF_VERIFICATION_CODE = "verification_code"
 REGION_NA = "NA"
 REGION_EU = "EU"
 
-KEYS_TO_REDACT: list[str] = [
+KEYS_TO_REDACT: frozenset[str] = frozenset({
     "access_token",
     "Authorization",
     "email",
     "family_name",
     "firstName",
-    "given_name,",
+    "given_name",
     "id_token",
     "lastName",
     "login",
@@ -34,4 +34,4 @@ KEYS_TO_REDACT: list[str] = [
     "token",
     "username",
     "Username",
-]
\ No newline at end of file
+})
\ No newline at end of file
@@ -7,25 +7,60 @@ REDACTED = "**REDACTED**"
 
 
 def redact_dict(data):
-    """Redact sensitive data in a dict."""
+    """
+    Redact sensitive data in a dict.
+    Only the containers leading to a redacted value are copied; everything else is shared with data
+    (which is returned as is when there is nothing to redact).
+    """
     if not isinstance(data, (Mapping, list)):
         return data
 
-    if isinstance(data, list):
-        return [redact_dict(val) for val in data]
+    # Walk the containers without recursion, collecting the path to each value to redact
+    paths: list[tuple] = []
+    stack: list[tuple[tuple, Any]] = [((), data)]
+    while stack:
+        path, node = stack.pop()
+        items = node.items() if isinstance(node, Mapping) else enumerate(node)
+        for key, value in items:
+            if value is None or value == "":
+                continue
+            if key.__class__ is str and key in KEYS_TO_REDACT:
+                paths.append(path + (key,))
+            elif isinstance(value, (Mapping, list)):
+                stack.append((path + (key,), value))
+    if not paths:
+        return data
+
+    root = _copy(data)
+    copies: dict[tuple, Any] = {(): root}
+    for path in paths:
+        parent = root
+        for depth in range(1, len(path)):
+            node = copies.get(path[:depth])
+            if node is None:
+                node = copies[path[:depth]] = _copy(parent[path[depth - 1]])
+                parent[path[depth - 1]] = node
+            parent = node
+        parent[path[-1]] = REDACTED
+    return root
+
+
+def _copy(container):
+    return {**container} if isinstance(container, Mapping) else list(container)
+
+
+def redacted(data) -> "_Redacted":
+    """Log argument that redacts data only if the message is actually emitted: _LOGGER.debug("%s", redacted(data))"""
+    return _Redacted(data)
+
+
+class _Redacted:
+    __slots__ = ("_data",)
 
-    redacted: Mapping[str, Any] = {**data}
+    def __init__(self, data) -> None:
+        self._data = data
 
-    for key, value in redacted.items():
-        if value is None:
-            continue
-        if isinstance(value, str) and not value:
-            continue
-        if key in KEYS_TO_REDACT:
-            redacted[key] = REDACTED
-        elif isinstance(value, Mapping):
-            redacted[key] = redact_dict(value)
-        elif isinstance(value, list):
-            redacted[key] = [redact_dict(item) for item in value]
+    def __str__(self) -> str:
+        return str(redact_dict(self._data))
 
-    return redacted
+    __repr__ = __str__
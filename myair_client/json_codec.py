@@ -0,0 +1,32 @@
+import json
+from typing import Any
+
+from aiohttp import ClientResponse
+
+try:
+    import orjson
+except ImportError:  # Optional: the standard library is used instead
+    orjson = None
+
+
+def loads(data: bytes | str) -> Any:
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def dumps(value: Any) -> str:
+    """For aiohttp's json_serialize, which expects a str"""
+    return orjson.dumps(value).decode("utf-8") if orjson else json.dumps(value)
+
+
+def is_json(content_type: str) -> bool:
+    return content_type == "application/json" or content_type.endswith("+json")
+
+
+async def read_json(response: ClientResponse) -> Any:
+    """The response body decoded as JSON straight from bytes (aiohttp's json() decodes it to a str first)"""
+    body = await response.read()
+    if not is_json(response.content_type):
+        # Raises the same ContentTypeError as before (e.g. on an HTML error page)
+        return await response.json()
+    body = body.strip()
+    return loads(body) if body else None
@@ -22,6 +22,12 @@ class ParsingError(Exception):
     pass
 
 
+class TokenExpiredError(AuthenticationError):
+    """This error is thrown when the GraphQL API rejects the access token as unauthorized"""
+
+    pass
+
+
 class MyAirConfig(NamedTuple):
     """
     This is our config for logging into MyAir
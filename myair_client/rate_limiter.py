@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from typing import Any
+from urllib.parse import urlsplit
+
+from aiohttp import ClientResponse, ClientSession
+
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+# Never slow down below this fraction of the configured rate
+MIN_RATE_FACTOR = 0.1
+# Fraction of the configured rate recovered after each successful request
+RECOVERY_FACTOR = 0.05
+# Slow down when fewer than this fraction of the server's rate limit window is left
+LOW_REMAINING_FACTOR = 0.1
+# Pause after a 429 that does not say for how long
+DEFAULT_PAUSE_SECONDS = 1.0
+
+
+class TokenBucket:
+    """
+    Paces requests to rate per second (bursts of up to burst requests).
+    The rate adapts to the server: halved when throttled, slowly recovered on success.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        self.max_rate: float = rate
+        self.rate: float = rate
+        self._burst: float = burst or max(1.0, rate)
+        self._tokens: float = self._burst
+        self._updated: float = time.monotonic()
+        self._paused_until: float = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # The lock keeps waiters in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Start again with an empty bucket when the pause ends, not with a full burst
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    def slow_down(self) -> None:
+        self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate / 2)
+
+    def recover(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FACTOR)
+
+
+class HostRateLimiter:
+    """
+    One token bucket and one in-flight cap per upstream host, shared by all the clients (accounts) of the process.
+    Fed back with the responses: 429 and Okta's X-Rate-Limit-* headers pause and slow down the host.
+    """
+
+    def __init__(self, rates: dict[str, float], default_rate: float, max_inflight: int) -> None:
+        self._rates: dict[str, float] = rates
+        self._default_rate: float = default_rate
+        self._max_inflight: int = max(1, max_inflight)
+        self._buckets: dict[str, TokenBucket] = {}
+        self._inflight: dict[str, asyncio.Semaphore] = {}
+
+    def bucket(self, host: str) -> TokenBucket:
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self._rates.get(host, self._default_rate))
+            self._inflight[host] = asyncio.Semaphore(self._max_inflight)
+        return self._buckets[host]
+
+    async def acquire(self, host: str) -> None:
+        bucket = self.bucket(host)
+        await self._inflight[host].acquire()
+        try:
+            await bucket.acquire()
+        except BaseException:
+            self._inflight[host].release()
+            raise
+
+    def release(self, host: str) -> None:
+        self._inflight[host].release()
+
+    def feedback(self, host: str, response: ClientResponse) -> None:
+        bucket = self.bucket(host)
+        headers = response.headers
+        if response.status == 429:
+            pause = self.__seconds_until_reset(headers) or DEFAULT_PAUSE_SECONDS
+            bucket.pause(pause)
+            bucket.slow_down()
+            _LOGGER.warning(f"Throttled by {host}. Pausing {pause:.1f}s, now at {bucket.rate:.2f} request(s)/s")
+            return
+
+        remaining, limit = headers.get("X-Rate-Limit-Remaining"), headers.get("X-Rate-Limit-Limit")
+        try:
+            low = remaining is not None and limit is not None and int(remaining) < int(limit) * LOW_REMAINING_FACTOR
+        except ValueError:
+            low = False
+        if low:
+            bucket.slow_down()
+            if int(remaining) <= 0:
+                bucket.pause(self.__seconds_until_reset(headers) or DEFAULT_PAUSE_SECONDS)
+        else:
+            bucket.recover()
+
+    @staticmethod
+    def __seconds_until_reset(headers: Any) -> float | None:
+        try:
+            if "X-Rate-Limit-Reset" in headers:
+                # Okta: epoch seconds at which the window resets
+                return max(0.0, float(headers["X-Rate-Limit-Reset"]) - time.time())
+            if "Retry-After" in headers:
+                return float(headers["Retry-After"])
+        except ValueError:
+            pass
+        return None
+
+    def wrap(self, session: ClientSession) -> "RateLimitedSession":
+        return RateLimitedSession(session, self)
+
+
+class _LimitedRequest:
+    def __init__(self, limiter: HostRateLimiter, request: Any, url: str, kwargs: dict[str, Any]) -> None:
+        self._limiter = limiter
+        self._request = request
+        self._url = url
+        self._kwargs = kwargs
+        self._host: str = urlsplit(url).hostname or ""
+        self._context: Any = None
+
+    async def __aenter__(self) -> ClientResponse:
+        await self._limiter.acquire(self._host)
+        try:
+            self._context = self._request(self._url, **self._kwargs)
+            response: ClientResponse = await self._context.__aenter__()
+        except BaseException:
+            self._limiter.release(self._host)
+            raise
+        self._limiter.feedback(self._host, response)
+        return response
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        try:
+            await self._context.__aexit__(*exc_info)
+        finally:
+            self._limiter.release(self._host)
+
+
+class RateLimitedSession:
+    """ClientSession whose get/post requests go through a HostRateLimiter"""
+
+    def __init__(self, session: ClientSession, limiter: HostRateLimiter) -> None:
+        self._session = session
+        self._limiter = limiter
+
+    def get(self, url: str, **kwargs: Any) -> _LimitedRequest:
+        return _LimitedRequest(self._limiter, self._session.get, url, kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> _LimitedRequest:
+        return _LimitedRequest(self._limiter, self._session.post, url, kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._session, name)
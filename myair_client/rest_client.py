@@ -1,12 +1,15 @@
+import asyncio
 import base64
+import collections
+from collections.abc import AsyncIterator, Awaitable, Callable
 import datetime
 import hashlib
 from http.cookies import SimpleCookie
 import logging
 import os
 import re
-from typing import Any
-from urllib.parse import DefragResult, parse_qs, urldefrag
+from typing import Any, TypeVar
+from urllib.parse import DefragResult, parse_qs, urldefrag, urlsplit
 
 from aiohttp import ClientResponse, ClientSession
 from aiohttp.http_exceptions import HttpProcessingError
@@ -17,7 +20,12 @@ from .const import (
     AUTHN_SUCCESS,
     REGION_NA,
 )
-from .helpers import redact_dict
+from .helpers import redacted
+from .json_codec import read_json
+from .rate_limiter import HostRateLimiter
+from .retry import RetryPolicy
+from .session_store import SESSION_KEYS, SessionStore, session_key
+from .token_manager import TokenManager
 
 from .myair_client import (
     AuthenticationError,
@@ -27,10 +35,13 @@ from .myair_client import (
     MyAirDevice,
     ParsingError,
     SleepRecord,
+    TokenExpiredError,
 )
 
 _LOGGER: logging.Logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 EU_CONFIG: dict[str, Any] = {
     # The name used in various queries
     "product": "myAir EU",
@@ -86,17 +97,91 @@ OAUTH_URLS: dict[str, Any] = {
     "userinfo_url": "https://{okta_url}/oauth2/{auth_server_id}/v1/userinfo",
 }
 
+def create_rate_limiter(auth_rate: float, graphql_rate: float, max_inflight: int) -> HostRateLimiter:
+    """Limiter with separate request rates for the Okta (authentication) and AppSync (GraphQL) hosts of all regions"""
+    rates: dict[str, float] = {}
+    for region_config in (NA_CONFIG, EU_CONFIG):
+        rates[region_config["okta_url"]] = auth_rate
+        rates[urlsplit(region_config["graphql_url"]).hostname] = graphql_rate
+    return HostRateLimiter(rates, graphql_rate, max_inflight)
+
+
+def month_windows(from_time: datetime, to_time: datetime) -> list[tuple[str, str]]:
+    """Split [from_time, to_time] into (start, end) dates, one per calendar month"""
+    windows: list[tuple[str, str]] = []
+    start: datetime.date = from_time.date()
+    end: datetime.date = to_time.date()
+    while start <= end:
+        next_month: datetime.date = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        window_end: datetime.date = min(end, next_month - datetime.timedelta(days=1))
+        windows.append((start.strftime("%Y-%m-%d"), window_end.strftime("%Y-%m-%d")))
+        start = next_month
+    return windows
+
+DEVICES_SELECTION: str = """fgDevices {
+                    serialNumber
+                    deviceType
+                    lastSleepDataReportTime
+                    localizedName
+                    fgDeviceManufacturerName
+                    fgDevicePatientId
+                    __typename
+                }"""
+
+
+def sleep_records_selection(start_month: str, end_month: str) -> str:
+    return """sleepRecords(startMonth: \"START_MONTH\", endMonth: \"END_MONTH\")
+                {
+                    items {
+                        startDate
+                        totalUsage
+                        sleepScore
+                        usageScore
+                        ahiScore
+                        maskScore
+                        leakScore
+                        ahi
+                        maskPairCount
+                        leakPercentile
+                        sleepRecordPatientId
+                        __typename
+                    }
+                    __typename
+                }""".replace(
+        "START_MONTH", start_month
+    ).replace(
+        "END_MONTH", end_month
+    )
+
+
+def merge_sleep_records(*windows: list[SleepRecord]) -> list[SleepRecord]:
+    """Records of all the windows by startDate; a night reported by two windows is kept once"""
+    merged: dict[str, SleepRecord] = {}
+    for records in windows:
+        for record in records:
+            merged[record["startDate"]] = record
+    return [merged[start_date] for start_date in sorted(merged)]
+
+
 class RESTClient(MyAirClient):
     """
     myAir uses oauth on Okta and AWS AppSync GraphQL
     """
 
-    def __init__(self, config: MyAirConfig, session: ClientSession) -> None:
+    def __init__(
+        self,
+        config: MyAirConfig,
+        session: ClientSession,
+        store: SessionStore | None = None,
+        limiter: HostRateLimiter | None = None,
+        retry: RetryPolicy | None = None,
+    ) -> None:
         _LOGGER.debug(
-            f"[RESTClient init] config: {redact_dict(config._asdict())}"
+            "[RESTClient init] config: %s", redacted(config._asdict())
         )
         self._config: MyAirConfig = config
-        self._session: ClientSession = session
+        # Requests are paced per host when the limiter is shared by many clients
+        self._session: ClientSession = limiter.wrap(session) if limiter else session
         self._json_headers: dict[str, Any] = {
             "Content-Type": "application/json",
             "Accept": "application/json",
@@ -118,6 +203,13 @@ class RESTClient(MyAirClient):
             okta_url=self._region_config["okta_url"],
             email_factor_id=self._email_factor_id,
         )
+        self._tokens: TokenManager = TokenManager(self._login)
+        # Host breakers are shared with the other clients using the same policy
+        self._retry: RetryPolicy = retry or RetryPolicy()
+        self._breaker = self._retry.breaker(f"account {session_key(config.username, config.region)[:8]}")
+        self._store: SessionStore | None = store
+        self._store_key: str = session_key(config.username, config.region)
+        self._load_session()
 
     @property
     def device_token(self) -> str | None:
@@ -133,13 +225,66 @@ class RESTClient(MyAirClient):
         # _LOGGER.debug(f"[cookies] returning cookies: {cookies}")
         return cookies
 
+    def _load_session(self) -> None:
+        if not self._store:
+            return
+        try:
+            stored: dict[str, Any] | None = self._store.load(self._store_key)
+        except Exception as e:
+            _LOGGER.warning(f"Unable to load stored session. {e.__class__.__qualname__}: {e}")
+            return
+        if not stored:
+            return
+        for key in SESSION_KEYS:
+            # An explicitly configured device token wins over the stored one
+            if getattr(self, f"_{key}", None) is None:
+                setattr(self, f"_{key}", stored.get(key, None))
+        self._tokens.update(self._access_token)
+        _LOGGER.info("Loaded stored session")
+
+    def _save_session(self) -> None:
+        if not self._store:
+            return
+        session: dict[str, Any] = {key: getattr(self, f"_{key}") for key in SESSION_KEYS}
+        try:
+            self._store.save(self._store_key, session)
+        except Exception as e:
+            _LOGGER.warning(f"Unable to store session. {e.__class__.__qualname__}: {e}")
+
     async def connect(self, initial: bool | None = False) -> str:
         if self._cookie_dt is None:
             await self._get_initial_dt()
         if self._cookie_dt is None and self._uses_mfa:
             _LOGGER.warning("Device Token isn't set. This will require frequent reauthentication.")
-        if self._access_token and await self._is_access_token_active():
-            return AUTHN_SUCCESS
+        if self._access_token:
+            valid: bool | None = self._tokens.is_valid()
+            if valid is None:
+                # Token lifetime unknown locally, ask Okta
+                valid = await self._with_retries(
+                    "introspect", f"https://{self._region_config['okta_url']}", self._is_access_token_active
+                )
+            if valid:
+                _LOGGER.debug("[connect] access token still valid")
+                return AUTHN_SUCCESS
+        return await self._tokens.refresh(initial)
+
+    async def close(self) -> None:
+        await self._tokens.close()
+
+    def set_next_use(self, when: float | None) -> None:
+        """Epoch seconds of the next time the client will be used (e.g. the next poll), None if not known"""
+        self._tokens.set_next_use(when)
+
+    async def _with_retries(self, step: str, url: str, call: Callable[[], Awaitable[T]]) -> T:
+        return await self._retry.run(step, urlsplit(url).hostname or url, self._breaker, call)
+
+    async def _login(self, initial: bool | None = False) -> str:
+        # Okta session tokens are single use: a failed login is retried from the start
+        return await self._with_retries(
+            "login", f"https://{self._region_config['okta_url']}", lambda: self._login_once(initial)
+        )
+
+    async def _login_once(self, initial: bool | None = False) -> str:
         _LOGGER.info("Starting Authentication")
         status: str = await self._authn_check()
         if status == AUTH_NEEDS_MFA:
@@ -174,7 +319,7 @@ class RESTClient(MyAirClient):
 
         _LOGGER.debug(f"[is_email_verified] authorize_url: {userinfo_url}")
         _LOGGER.debug(
-            f"[is_email_verified] headers: {redact_dict(headers)}"
+            "[is_email_verified] headers: %s", redacted(headers)
         )
 
         async with self._session.get(
@@ -183,9 +328,9 @@ class RESTClient(MyAirClient):
             allow_redirects=False,
         ) as userinfo_res:
             _LOGGER.debug(f"[is_email_verified] userinfo_res: {userinfo_res}")
-            userinfo_dict: dict[str, Any] = await userinfo_res.json()
+            userinfo_dict: dict[str, Any] = await read_json(userinfo_res)
             _LOGGER.debug(
-                f"[is_email_verified] introspect_dict: {redact_dict(userinfo_dict)}"
+                "[is_email_verified] introspect_dict: %s", redacted(userinfo_dict)
             )
             await self._resmed_response_error_check(
                 "userinfo_query", userinfo_res, userinfo_dict
@@ -214,6 +359,8 @@ class RESTClient(MyAirClient):
                 _LOGGER.info(f"Updating to new sid cookie")
             self._cookie_sid = cookies.get("sid", self._cookie_sid)
         _LOGGER.debug(f"[extract_and_update_cookies] updated cookies: {self._cookies}")
+        if cookies:
+            self._save_session()
 
     async def _get_initial_dt(self) -> None:
         initial_dt_url: str = OAUTH_URLS["authorize_url"].format(
@@ -222,7 +369,7 @@ class RESTClient(MyAirClient):
         )
         _LOGGER.debug(f"[get_initial_dt] initial_dt_url: {initial_dt_url}")
         _LOGGER.debug(
-            f"[get_initial_dt] headers: {redact_dict(self._json_headers)}"
+            "[get_initial_dt] headers: %s", redacted(self._json_headers)
         )
 
         async with self._session.get(
@@ -253,19 +400,20 @@ class RESTClient(MyAirClient):
         }
         _LOGGER.debug(f"[is_access_token_active] introspect_url: {introspect_url}")
         _LOGGER.debug(
-            f"[is_access_token_active] headers: {redact_dict(headers)}"
+            "[is_access_token_active] headers: %s", redacted(headers)
         )
         _LOGGER.debug(
-            f"[is_access_token_active] introspect_query: {redact_dict(introspect_query)}"
+            "[is_access_token_active] introspect_query: %s", redacted(introspect_query)
         )
 
         async with self._session.post(
             introspect_url, headers=headers, data=introspect_query, cookies=self._cookies
         ) as introspect_res:
             _LOGGER.debug(f"[is_access_token_active] introspect_res: {introspect_res}")
-            introspect_dict: dict[str, Any] = await introspect_res.json()
+            self._transient_status_check("introspect_query", introspect_res)
+            introspect_dict: dict[str, Any] = await read_json(introspect_res)
             _LOGGER.debug(
-                f"[is_access_token_active] introspect_dict: {redact_dict(introspect_dict)}"
+                "[is_access_token_active] introspect_dict: %s", redacted(introspect_dict)
             )
             await self._resmed_response_error_check(
                 "introspect_query", introspect_res, introspect_dict
@@ -275,6 +423,19 @@ class RESTClient(MyAirClient):
             return True
         return False
 
+    def _transient_status_check(self, step: str, response: ClientResponse) -> None:
+        """
+        Raise on throttling (429) and server errors (5xx), before the body is parsed: their body may well be JSON
+        (e.g. API Gateway's {"message": "Internal server error"}), which would then fail as an unexpected payload
+        instead of being retried
+        """
+        if response.status == 429 or response.status >= 500:
+            raise HttpProcessingError(
+                code=response.status,
+                message=f"{step} step: HTTP {response.status} {response.reason}",
+                headers=response.headers, # type: ignore
+            )
+
     async def _resmed_response_error_check(
         self, step: str, response: ClientResponse, resp_dict: dict, initial: bool | None = False
     ) -> None:
@@ -283,7 +444,7 @@ class RESTClient(MyAirClient):
                 error_message: str = f"{resp_dict['errors'][0]['errorInfo']['errorType']}: {resp_dict['errors'][0]['errorInfo']['errorCode']}"
                 if resp_dict["errors"][0]["errorInfo"]["errorType"] == "unauthorized":
                     if step == "gql_query" and not initial:
-                        raise ParsingError(f"Getting unauthorized error on {step} step. {error_message}")
+                        raise TokenExpiredError(f"Getting unauthorized error on {step} step. {error_message}")
                     raise AuthenticationError(
                         f"Getting unauthorized error on {step} step. {error_message}"
                     )
@@ -312,10 +473,10 @@ class RESTClient(MyAirClient):
         }
         _LOGGER.debug(f"[authn_check] authn_url: {authn_url}")
         _LOGGER.debug(
-            f"[authn_check] headers: {redact_dict(self._json_headers)}"
+            "[authn_check] headers: %s", redacted(self._json_headers)
         )
         _LOGGER.debug(
-            f"[authn_check] json_query: {redact_dict(json_query)}"
+            "[authn_check] json_query: %s", redacted(json_query)
         )
 
         async with self._session.post(
@@ -325,9 +486,10 @@ class RESTClient(MyAirClient):
             cookies=self._cookies,
         ) as authn_res:
             _LOGGER.debug(f"[authn_check] authn_res: {authn_res}")
-            authn_dict: dict[str, Any] = await authn_res.json()
+            self._transient_status_check("authn", authn_res)
+            authn_dict: dict[str, Any] = await read_json(authn_res)
             _LOGGER.debug(
-                f"[authn_check] authn_dict: {redact_dict(authn_dict)}"
+                "[authn_check] authn_dict: %s", redacted(authn_dict)
             )
             await self._resmed_response_error_check("authn", authn_res, authn_dict)
         if "status" not in authn_dict:
@@ -364,10 +526,10 @@ class RESTClient(MyAirClient):
         json_query: dict[str, Any] = {"passCode": "", "stateToken": self._state_token}
         _LOGGER.debug(f"[trigger_mfa] mfa_url: {self._mfa_url}")
         _LOGGER.debug(
-            f"[trigger_mfa] headers: {redact_dict(self._json_headers)}"
+            "[trigger_mfa] headers: %s", redacted(self._json_headers)
         )
         _LOGGER.debug(
-            f"[trigger_mfa] json_query: {redact_dict(json_query)}"
+            "[trigger_mfa] json_query: %s", redacted(json_query)
         )
 
         async with self._session.post(
@@ -377,9 +539,9 @@ class RESTClient(MyAirClient):
             cookies=self._cookies,
         ) as trigger_mfa_res:
             _LOGGER.debug(f"[trigger_mfa] trigger_mfa_res: {trigger_mfa_res}")
-            trigger_mfa_dict: dict[str, Any] = await trigger_mfa_res.json()
+            trigger_mfa_dict: dict[str, Any] = await read_json(trigger_mfa_res)
             _LOGGER.debug(
-                f"[trigger_mfa] trigger_mfa_dict: {redact_dict(trigger_mfa_dict)}"
+                "[trigger_mfa] trigger_mfa_dict: %s", redacted(trigger_mfa_dict)
             )
             await self._resmed_response_error_check(
                 "trigger_mfa", trigger_mfa_res, trigger_mfa_dict
@@ -392,7 +554,7 @@ class RESTClient(MyAirClient):
         json_query: dict[str, Any] = {"passCode": verification_code, "stateToken": self._state_token}
         _LOGGER.debug(f"[verify_mfa] mfa_url: {self._mfa_url}")
         _LOGGER.debug(
-            f"[verify_mfa] headers: {redact_dict(self._json_headers)}"
+            "[verify_mfa] headers: %s", redacted(self._json_headers)
         )
         _LOGGER.debug(f"[verify_mfa] json_query: {json_query}")
 
@@ -403,9 +565,9 @@ class RESTClient(MyAirClient):
             cookies=self._cookies,
         ) as verify_mfa_res:
             _LOGGER.debug(f"[verify_mfa] verify_mfa_res: {verify_mfa_res}")
-            verify_mfa_dict: dict[str, Any] = await verify_mfa_res.json()
+            verify_mfa_dict: dict[str, Any] = await read_json(verify_mfa_res)
             _LOGGER.debug(
-                f"[verify_mfa] verify_mfa_dict: {redact_dict(verify_mfa_dict)}"
+                "[verify_mfa] verify_mfa_dict: %s", redacted(verify_mfa_dict)
             )
             await self._resmed_response_error_check(
                 "verify_mfa", verify_mfa_res, verify_mfa_dict
@@ -455,10 +617,10 @@ class RESTClient(MyAirClient):
         }
         _LOGGER.debug(f"[get_access_token code] authorize_url: {authorize_url}")
         _LOGGER.debug(
-            f"[get_access_token code] headers: {redact_dict(self._json_headers)}"
+            "[get_access_token code] headers: %s", redacted(self._json_headers)
         )
         _LOGGER.debug(
-            f"[get_access_token code] params_query: {redact_dict(params_query)}"
+            "[get_access_token code] params_query: %s", redacted(params_query)
         )
 
         async with self._session.get(
@@ -469,6 +631,7 @@ class RESTClient(MyAirClient):
             cookies=self._cookies,
         ) as code_res:
             _LOGGER.debug(f"[get_access_token] code_res: {code_res}")
+            self._transient_status_check("get_access_token code", code_res)
             if "location" not in code_res.headers:
                 raise ParsingError("Unable to get location from code_res")
             location: str = code_res.headers["location"]
@@ -501,10 +664,10 @@ class RESTClient(MyAirClient):
         )
         _LOGGER.debug(f"[get_access_token token] token_url: {token_url}")
         _LOGGER.debug(
-            f"[get_access_token token] headers: {redact_dict(headers)}"
+            "[get_access_token token] headers: %s", redacted(headers)
         )
         _LOGGER.debug(
-            f"[get_access_token token] token_query: {redact_dict(token_query)}"
+            "[get_access_token token] token_query: %s", redacted(token_query)
         )
 
         async with self._session.post(
@@ -515,9 +678,10 @@ class RESTClient(MyAirClient):
             cookies=self._cookies,
         ) as token_res:
             _LOGGER.debug(f"[get_access_token] token_res: {token_res}")
-            token_dict: dict[str, Any] = await token_res.json()
+            self._transient_status_check("get_access_token", token_res)
+            token_dict: dict[str, Any] = await read_json(token_res)
             _LOGGER.debug(
-                f"[get_access_token] token_dict: {redact_dict(token_dict)}"
+                "[get_access_token] token_dict: %s", redacted(token_dict)
             )
             await self._resmed_response_error_check(
                 "get_access_token", token_res, token_dict
@@ -531,8 +695,26 @@ class RESTClient(MyAirClient):
                 if self._access_token is not None:
                     _LOGGER.info(f"Obtained new access token")
                 self._access_token = token_dict.get("access_token", self._access_token)
+        self._tokens.update(self._access_token)
+        self._save_session()
 
     async def _gql_query(self, operation_name: str, query: str, initial: bool | None = False) -> dict[str, Any]:
+        graphql_url: str = self._region_config["graphql_url"]
+
+        def post() -> Awaitable[dict[str, Any]]:
+            return self._gql_post(operation_name, query, initial)
+
+        try:
+            return await self._with_retries(operation_name, graphql_url, post)
+        except TokenExpiredError:
+            # Token revoked or expired earlier than announced: log in again (once, shared with
+            # any concurrent query) and retry
+            _LOGGER.info(f"Access token rejected on {operation_name}. Re-authenticating")
+            self._tokens.invalidate()
+            await self._tokens.refresh()
+            return await self._with_retries(operation_name, graphql_url, post)
+
+    async def _gql_post(self, operation_name: str, query: str, initial: bool | None = False) -> dict[str, Any]:
         _LOGGER.debug(f"[gql_query] operation_name: {operation_name}, query: {query}")
         authz_header: str = f"Bearer {self._access_token}"
         # _LOGGER.debug(f"[gql_query] authz_header: {authz_header}")
@@ -550,7 +732,7 @@ class RESTClient(MyAirClient):
                 )
                 raise ParsingError("Unable to decode id_token into jwt_data") from e
             _LOGGER.debug(
-                f"[gql_query] jwt_data: {redact_dict(jwt_data)}"
+                "[gql_query] jwt_data: %s", redacted(jwt_data)
             )
 
             # The graphql API only works properly if we provide the expected country code
@@ -560,6 +742,7 @@ class RESTClient(MyAirClient):
                 raise ParsingError("myAirCountryId not found in jwt_data")
             self._country_code = jwt_data["myAirCountryId"]
             _LOGGER.info(f"Country Code: {self._country_code}")
+            self._save_session()
         if not self._country_code:
             _LOGGER.error(
                 "country_code not defined and id_token not present to identify it"
@@ -584,6 +767,8 @@ class RESTClient(MyAirClient):
             "rmdhandsetplatform": "Web",
             "rmdcountry": self._country_code,
             "accept-language": "en-US,en;q=0.9",
+            # Sleep records compress well; aiohttp decompresses the response transparently
+            "accept-encoding": "gzip, deflate",
         }
         json_query: dict[str, Any] = {
             "operationName": operation_name,
@@ -592,10 +777,10 @@ class RESTClient(MyAirClient):
         }
         _LOGGER.debug(f"[gql_query] graphql_url: {graphql_url}")
         _LOGGER.debug(
-            f"[gql_query] headers: {redact_dict(headers)}"
+            "[gql_query] headers: %s", redacted(headers)
         )
         _LOGGER.debug(
-            f"[gql_query] json_query: {redact_dict(json_query)}"
+            "[gql_query] json_query: %s", redacted(json_query)
         )
 
         async with self._session.post(
@@ -604,9 +789,14 @@ class RESTClient(MyAirClient):
             json=json_query,
         ) as records_res:
             _LOGGER.debug(f"[gql_query] records_res: {records_res}")
-            records_dict: dict[str, Any] = await records_res.json()
+            self._transient_status_check("gql_query", records_res)
             _LOGGER.debug(
-                f"[gql_query] records_dict: {redact_dict(records_dict)}"
+                f"[gql_query] content-encoding: {records_res.headers.get('Content-Encoding')}, "
+                f"content-length: {records_res.headers.get('Content-Length')}"
+            )
+            records_dict: dict[str, Any] = await read_json(records_res)
+            _LOGGER.debug(
+                "[gql_query] records_dict: %s", redacted(records_dict)
             )
             await self._resmed_response_error_check(
                 "gql_query", records_res, records_dict, initial
@@ -614,46 +804,132 @@ class RESTClient(MyAirClient):
 
         return records_dict
 
-    async def get_sleep_records(self, from_time: datetime, to_time: datetime) -> list[SleepRecord]:
-        end_month = to_time.strftime("%Y-%m-%d")
-        start_month = from_time.strftime("%Y-%m-%d")
+    async def get_sleep_records(
+        self, from_time: datetime, to_time: datetime, month_concurrency: int | None = None
+    ) -> list[SleepRecord]:
+        """
+        Sleep records between from_time and to_time (at month granularity).
+        With month_concurrency, the span is fetched as one request per month, up to month_concurrency at a time,
+        each month being retried on its own if it fails transiently.
+        """
+        if not month_concurrency:
+            return await self._get_sleep_records_window(
+                from_time.strftime("%Y-%m-%d"), to_time.strftime("%Y-%m-%d")
+            )
 
+        windows: list[tuple[str, str]] = month_windows(from_time, to_time)
+        _LOGGER.info(f"Getting Sleep Records for {len(windows)} month(s)")
+        return merge_sleep_records(*[records async for records in self.iter_sleep_records(windows, month_concurrency)])
+
+    async def get_device_and_sleep_records(
+        self,
+        from_time: datetime,
+        to_time: datetime,
+        month_concurrency: int | None = None,
+        last_report_time: str | None = None,
+    ) -> tuple[MyAirDevice, AsyncIterator[list[SleepRecord]] | None]:
+        """
+        Device data and sleep records between from_time and to_time, fetched in the same GraphQL request
+        instead of two in a row. With month_concurrency, that request covers the most recent month and the
+        older months are fetched afterwards, as the records are consumed.
+        The records come as an iterator of chunks (one per month with month_concurrency) so that a long history
+        is never held in memory at once; it is None when the device did not report anything since last_report_time.
+        """
+        if month_concurrency:
+            windows: list[tuple[str, str]] = month_windows(from_time, to_time)
+        else:
+            windows = [(from_time.strftime("%Y-%m-%d"), to_time.strftime("%Y-%m-%d"))]
+        device, records = await self._get_device_and_sleep_records_window(*windows[-1])
+        if last_report_time and device["lastSleepDataReportTime"] == last_report_time:
+            # The speculatively fetched records are dropped: cheaper than a second round trip when there is new data
+            return device, None
+
+        async def chunks() -> AsyncIterator[list[SleepRecord]]:
+            # Windows don't overlap, but a night reported by two windows next to each other is kept once.
+            # Only the dates of the last windows are remembered, so memory does not grow with the history
+            latest: set[str] = {record["startDate"] for record in records}
+            previous: set[str] = set()
+            first: list[SleepRecord] | None = records
+            async for window_records in self.iter_sleep_records(windows[:-1], month_concurrency):
+                if first is not None:
+                    # The most recent month, already fetched
+                    yield first
+                    first = None
+                new = [r for r in window_records if r["startDate"] not in previous and r["startDate"] not in latest]
+                previous = {record["startDate"] for record in new}
+                yield new
+            if first is not None:
+                yield first
+
+        return device, chunks()
+
+    async def iter_sleep_records(
+        self, windows: list[tuple[str, str]], month_concurrency: int | None = None
+    ) -> AsyncIterator[list[SleepRecord]]:
+        """Records of each (start, end) window, in window order, fetching up to month_concurrency windows ahead"""
+        pending: collections.deque[asyncio.Task] = collections.deque()
+        try:
+            for window in windows:
+                pending.append(asyncio.create_task(self._get_sleep_records_window(*window)))
+                if len(pending) >= max(1, month_concurrency or 1):
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # The consumer stopped early (or failed): don't leave requests running
+            for task in pending:
+                task.cancel()
+
+    async def _get_device_and_sleep_records_window(
+        self, start_month: str, end_month: str
+    ) -> tuple[MyAirDevice, list[SleepRecord]]:
+        query: str = """query GetPatientDevicesAndSleepRecords {
+            getPatientWrapper {
+                DEVICES
+                SLEEP_RECORDS
+            __typename
+            }
+        }
+        """.replace(
+            "DEVICES", DEVICES_SELECTION
+        ).replace(
+            "SLEEP_RECORDS", sleep_records_selection(start_month, end_month)
+        )
+
+        _LOGGER.info("Getting User Device Data and Sleep Records")
+        records_dict: dict[str, Any] = await self._gql_query("GetPatientDevicesAndSleepRecords", query)
+        _LOGGER.debug(
+            "[get_device_and_sleep_records] records_dict: %s", redacted(records_dict)
+        )
+        try:
+            wrapper: dict[str, Any] = records_dict["data"]["getPatientWrapper"]
+            device: MyAirDevice = wrapper["fgDevices"][0]
+            records: list[SleepRecord] = wrapper["sleepRecords"]["items"]
+        except Exception as e:
+            _LOGGER.error(
+                f"Error getting User Device Data and Sleep Records. {e.__class__.__qualname__}: {e}"
+            )
+            raise ParsingError("Error getting User Device Data and Sleep Records") from e
+        return device, records
+
+    async def _get_sleep_records_window(self, start_month: str, end_month: str) -> list[SleepRecord]:
         query: str = """query GetPatientSleepRecords {
             getPatientWrapper {
                 patient {
                     firstName
                 }
-                sleepRecords(startMonth: \"START_MONTH\", endMonth: \"END_MONTH\")
-                {
-                    items {
-                        startDate
-                        totalUsage
-                        sleepScore
-                        usageScore
-                        ahiScore
-                        maskScore
-                        leakScore
-                        ahi
-                        maskPairCount
-                        leakPercentile
-                        sleepRecordPatientId
-                        __typename
-                    }
-                    __typename
-                }
+                SLEEP_RECORDS
             __typename
             }
         }
         """.replace(
-            "START_MONTH", start_month
-        ).replace(
-            "END_MONTH", end_month
+            "SLEEP_RECORDS", sleep_records_selection(start_month, end_month)
         )
 
         _LOGGER.info("Getting Sleep Records")
         records_dict: dict[str, Any] = await self._gql_query("GetPatientSleepRecords", query)
         _LOGGER.debug(
-            f"[get_sleep_records] records_dict: {redact_dict(records_dict)}"
+            "[get_sleep_records] records_dict: %s", redacted(records_dict)
         )
         try:
             records: list[SleepRecord] = records_dict["data"]["getPatientWrapper"]["sleepRecords"]["items"]
@@ -663,7 +939,7 @@ class RESTClient(MyAirClient):
             )
             raise ParsingError("Error getting Patient Sleep Records") from e
         _LOGGER.debug(
-            f"[get_sleep_records] records: {redact_dict(records)}"
+            "[get_sleep_records] records: %s", redacted(records)
         )
         return records
 
@@ -671,23 +947,17 @@ class RESTClient(MyAirClient):
         query: str = """
         query getPatientWrapper {
             getPatientWrapper {
-                fgDevices {
-                    serialNumber
-                    deviceType
-                    lastSleepDataReportTime
-                    localizedName
-                    fgDeviceManufacturerName
-                    fgDevicePatientId
-                    __typename
-                }
+                DEVICES
             }
         }
-        """
+        """.replace(
+            "DEVICES", DEVICES_SELECTION
+        )
 
         _LOGGER.info("Getting User Device Data")
         records_dict: dict[str, Any] = await self._gql_query("getPatientWrapper", query, initial)
         _LOGGER.debug(
-            f"[get_user_device_data] records_dict: {redact_dict(records_dict)}"
+            "[get_user_device_data] records_dict: %s", redacted(records_dict)
         )
         try:
             device: MyAirDevice = records_dict["data"]["getPatientWrapper"]["fgDevices"][0]
@@ -697,6 +967,6 @@ class RESTClient(MyAirClient):
             )
             raise ParsingError("Error getting User Device Data") from e
         _LOGGER.debug(
-            f"[get_user_device_data] device: {redact_dict(device)}"
+            "[get_user_device_data] device: %s", redacted(device)
         )
         return device
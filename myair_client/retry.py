@@ -0,0 +1,152 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+import logging
+import random
+import time
+from typing import TypeVar
+
+from aiohttp import ClientConnectionError, ClientPayloadError, ClientResponseError
+from aiohttp.http_exceptions import HttpProcessingError
+
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BASE_DELAY_SECONDS = 1.0
+DEFAULT_MAX_DELAY_SECONDS = 30.0
+# Consecutive failures after which a breaker opens, and how long it stays open
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_SECONDS = 60.0
+
+
+class CircuitOpenError(Exception):
+    """This error is thrown when a call is refused because its upstream (host or account) keeps failing"""
+
+    pass
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Transient failures worth retrying: timeouts, dropped connections, throttling and server errors.
+    Everything else (authentication, incomplete account, policy not accepted, unexpected payload) is fatal.
+    """
+    if isinstance(error, (asyncio.TimeoutError, ClientConnectionError, ClientPayloadError)):
+        return True
+    if isinstance(error, ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    if isinstance(error, HttpProcessingError):
+        return error.code == 429 or error.code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and refuses calls for reset_seconds,
+    then lets a single trial call through (half-open) to decide whether to close again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_seconds: float = DEFAULT_RESET_SECONDS) -> None:
+        self.name: str = name
+        self._failure_threshold: int = failure_threshold
+        self._reset_seconds: float = reset_seconds
+        self._failures: int = 0
+        self._opened_at: float | None = None
+        self._trial_running: bool = False
+
+    def before(self) -> bool:
+        """Raise CircuitOpenError if the call is refused; True if it is the trial call of a half-open breaker"""
+        if self._opened_at is None:
+            return False
+        if time.monotonic() - self._opened_at < self._reset_seconds or self._trial_running:
+            raise CircuitOpenError(f"Too many failures on {self.name}, not trying again for now")
+        self._trial_running = True
+        return True
+
+    def abort(self) -> None:
+        """The trial call allowed by before() has no outcome (it did not happen, or was cancelled)"""
+        self._trial_running = False
+
+    def success(self) -> None:
+        if self._opened_at is not None:
+            _LOGGER.info(f"{self.name} recovered")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    def failure(self) -> None:
+        self._failures += 1
+        self._trial_running = False
+        if self._opened_at is not None or self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                _LOGGER.warning(f"{self.name} failed {self._failures} times in a row. Pausing calls for {self._reset_seconds:.0f}s")
+            self._opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Bounded retries with jittered exponential backoff for transient failures.
+    Calls go through a breaker per host (shared by every client using this policy) and a breaker per account.
+    """
+
+    def __init__(
+        self,
+        attempts: int = DEFAULT_ATTEMPTS,
+        base_delay: float = DEFAULT_BASE_DELAY_SECONDS,
+        max_delay: float = DEFAULT_MAX_DELAY_SECONDS,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        reset_seconds: float = DEFAULT_RESET_SECONDS,
+    ) -> None:
+        self._attempts: int = max(1, attempts)
+        self._base_delay: float = base_delay
+        self._max_delay: float = max_delay
+        self._failure_threshold: int = failure_threshold
+        self._reset_seconds: float = reset_seconds
+        self._host_breakers: dict[str, CircuitBreaker] = {}
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        return CircuitBreaker(name, self._failure_threshold, self._reset_seconds)
+
+    def host_breaker(self, host: str) -> CircuitBreaker:
+        if host not in self._host_breakers:
+            self._host_breakers[host] = self.breaker(host)
+        return self._host_breakers[host]
+
+    async def run(self, step: str, host: str, account_breaker: CircuitBreaker, call: Callable[[], Awaitable[T]]) -> T:
+        host_breaker = self.host_breaker(host)
+        for attempt in range(self._attempts):
+            host_trial = host_breaker.before()
+            try:
+                account_trial = account_breaker.before()
+            except CircuitOpenError:
+                if host_trial:
+                    host_breaker.abort()
+                raise
+            try:
+                result = await call()
+            except Exception as e:
+                retryable = is_retryable(e)
+                # A host is only blamed for transient failures; an account for any failure
+                if retryable:
+                    host_breaker.failure()
+                else:
+                    host_breaker.success()
+                account_breaker.failure()
+                if not retryable or attempt == self._attempts - 1:
+                    raise
+                delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+                _LOGGER.warning(f"{step} failed ({e.__class__.__qualname__}: {e}). Retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled (or interrupted): no outcome. Let the next call be the trial, or the breakers
+                # would refuse every call from now on
+                if host_trial:
+                    host_breaker.abort()
+                if account_trial:
+                    account_breaker.abort()
+                raise
+            host_breaker.success()
+            account_breaker.success()
+            return result
+        raise AssertionError("unreachable")
@@ -0,0 +1,144 @@
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+from typing import Any
+
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+# RESTClient attributes persisted between runs
+SESSION_KEYS: tuple[str, ...] = (
+    "access_token",
+    "id_token",
+    "cookie_dt",
+    "cookie_sid",
+    "country_code",
+)
+
+
+def session_key(username: str, region: str) -> str:
+    """Key a session by account without writing the login in clear to disk"""
+    return hashlib.sha256(f"{region}:{username.lower()}".encode("utf-8")).hexdigest()
+
+
+class SessionStore(ABC):
+    """
+    Persists the tokens and cookies of a RESTClient so that a restart
+    does not have to go through the full Okta login again
+    """
+
+    @abstractmethod
+    def load(self, key: str) -> dict[str, Any] | None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def save(self, key: str, session: dict[str, Any]) -> None:
+        raise NotImplementedError()
+
+    def delete(self, key: str) -> None:
+        self.save(key, {})
+
+
+class FileSessionStore(SessionStore):
+    """
+    One small JSON file per account in a folder, created with the given mode (e.g. 0o600: readable by the owner only):
+    loading or saving a session never reads or rewrites the sessions of the other accounts
+    """
+
+    def __init__(self, folder: str | Path, mode: int, legacy_path: str | Path | None = None) -> None:
+        self._folder = Path(folder)
+        self._mode: int = mode
+        self._folder.mkdir(parents=True, exist_ok=True)
+        if legacy_path and Path(legacy_path).exists():
+            self._migrate(Path(legacy_path))
+
+    def _path(self, key: str) -> Path:
+        return self._folder / f"{key}.json"
+
+    def load(self, key: str) -> dict[str, Any] | None:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            _LOGGER.warning(f"Ignoring corrupted session file {self._path(key)}")
+            return None
+
+    def save(self, key: str, session: dict[str, Any]) -> None:
+        path = self._path(key)
+        if not session:
+            path.unlink(missing_ok=True)
+            return
+        # Write to a private temp file then rename, so a crash never leaves a truncated session.
+        # The temp file is per process: several processes may save the same account, the last rename wins
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self._mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(session, f)
+        os.replace(tmp, path)
+
+    def _migrate(self, legacy_path: Path) -> None:
+        """Split the single file all the sessions used to be kept in"""
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                sessions: dict[str, dict[str, Any]] = json.load(f)
+        except ValueError:
+            sessions = {}
+        for key, session in sessions.items():
+            if not self._path(key).exists():
+                self.save(key, session)
+        legacy_path.unlink(missing_ok=True)
+        _LOGGER.info(f"Moved {len(sessions)} stored session(s) to {self._folder}")
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions in a SQLite database, opened with connect (which sets up the file: location, permissions, locking)"""
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]) -> None:
+        self._connect_db = connect
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db = self._connect_db()
+        try:
+            with db:  # commits on success, rolls back on error
+                yield db
+        finally:
+            db.close()
+
+    def load(self, key: str) -> dict[str, Any] | None:
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM sessions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, key: str, session: dict[str, Any]) -> None:
+        with self._connect() as db:
+            if session:
+                db.execute("INSERT OR REPLACE INTO sessions (key, data) VALUES (?, ?)", (key, json.dumps(session)))
+            else:
+                db.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+
+def create_session_store(
+    backend: str, folder: str | Path, file_mode: int, connect_sqlite: Callable[[Path], sqlite3.Connection]
+) -> SessionStore | None:
+    """
+    Build the store for a backend name ("file", "sqlite"). Empty backend disables persistence.
+    Session files are created with file_mode; the SQLite database is opened with connect_sqlite
+    """
+    if not backend or not folder:
+        return None
+    if backend == "file":
+        return FileSessionStore(Path(folder) / "sessions", file_mode, legacy_path=Path(folder) / "sessions.json")
+    if backend == "sqlite":
+        path = Path(folder) / "state.sqlite"
+        return SqliteSessionStore(lambda: connect_sqlite(path))
+    raise ValueError(f"Unknown session store: {backend}")
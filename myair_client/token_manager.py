@@ -0,0 +1,133 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+import logging
+import time
+from typing import Any
+
+import jwt
+
+from .myair_client import AuthenticationError
+
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+# Consider the access token expired this many seconds before its "exp" claim,
+# and renew it in the background at that time (if it is going to be used)
+DEFAULT_EXPIRY_MARGIN_SECONDS = 120
+# Wait before trying again when a background renewal fails for a transient reason
+RETRY_SECONDS = 60
+
+
+def token_expiry(token: str | None) -> float | None:
+    """Return the "exp" claim of a JWT as an epoch timestamp, or None if the token is not a readable JWT"""
+    if not token:
+        return None
+    try:
+        # We trust this JWT because it is myAir giving it to us, and only need its claims
+        claims: dict[str, Any] = jwt.decode(
+            token, options={"verify_signature": False, "verify_exp": False, "verify_aud": False}
+        )
+    except Exception:
+        return None
+    exp = claims.get("exp", None)
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
+class TokenManager:
+    """
+    Tracks the lifetime of the myAir access token:
+    - validity is decided locally from the JWT "exp" claim instead of calling the introspect endpoint
+    - the token is renewed in the background shortly before it expires, but only if it is going to be used
+      (next_use) before the renewed token expires: otherwise connect() logs in again on demand, which keeps
+      password logins to one per poll at most
+    - concurrent renewals are coalesced into a single login (single-flight)
+    """
+
+    def __init__(
+        self, login: Callable[..., Awaitable[str]], margin_seconds: float = DEFAULT_EXPIRY_MARGIN_SECONDS
+    ) -> None:
+        self._login = login
+        self._margin: float = margin_seconds
+        self._expires_at: float | None = None
+        # Longest lifetime seen of a token, i.e. how long a renewed token would last
+        self._lifetime: float = 0
+        # Epoch seconds of the next time the token is needed (e.g. the account's next poll), if known
+        self._next_use: float | None = None
+        self._inflight: asyncio.Future | None = None
+        self._background: asyncio.Task | None = None
+
+    @property
+    def expires_at(self) -> float | None:
+        return self._expires_at
+
+    def update(self, access_token: str | None) -> None:
+        """Record a newly obtained (or loaded) access token"""
+        self._expires_at = token_expiry(access_token)
+        if self._expires_at:
+            self._lifetime = max(self._lifetime, self._expires_at - time.time())
+            self._start_background()
+
+    def set_next_use(self, when: float | None) -> None:
+        """When the token will be needed next (None if not known): only then is it worth renewing in the background"""
+        self._next_use = when
+        if self._expires_at and self._needed_soon():
+            self._start_background()
+
+    def _needed_soon(self) -> bool:
+        """Whether a token renewed now would be used before it expires"""
+        return self._next_use is not None and self._next_use < time.time() + self._lifetime
+
+    def invalidate(self) -> None:
+        self._expires_at = 0
+
+    def is_valid(self) -> bool | None:
+        """True/False when the token lifetime is known locally, None when it has to be asked to the server"""
+        if self._expires_at is None:
+            return None
+        return time.time() < self._expires_at - self._margin
+
+    async def refresh(self, *args: Any) -> str:
+        """Log in again. Callers arriving while a login is in flight share its result"""
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._login(*args))
+        # Shielded so that a cancelled caller does not abort the login the others are waiting on
+        return await asyncio.shield(self._inflight)
+
+    def _start_background(self) -> None:
+        if self._background and not self._background.done():
+            return
+        try:
+            self._background = asyncio.get_running_loop().create_task(self._renew_forever())
+        except RuntimeError:
+            # No running loop (e.g. client built outside of async code): renew on demand only
+            self._background = None
+
+    async def _renew_forever(self) -> None:
+        while self._expires_at:
+            delay = self._expires_at - self._margin - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if not self._needed_soon():
+                _LOGGER.debug("Access token about to expire, not needed before a renewed one would. Renewing on demand")
+                return
+            try:
+                _LOGGER.info("Access token about to expire. Renewing")
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except AuthenticationError as e:
+                # Needs user interaction (e.g. MFA) or bad credentials: leave it to the next sync to report
+                _LOGGER.warning(f"Unable to renew access token in the background. {e}")
+                return
+            except Exception as e:
+                _LOGGER.warning(f"Unable to renew access token in the background. {e.__class__.__qualname__}: {e}")
+                await asyncio.sleep(RETRY_SECONDS)
+
+    async def close(self) -> None:
+        if self._background and not self._background.done():
+            self._background.cancel()
+            try:
+                await self._background
+            except asyncio.CancelledError:
+                pass
+        self._background = None
@@ -0,0 +1,142 @@
+from array import array
+from collections.abc import Collection, Iterator, Mapping
+from functools import lru_cache
+from typing import NamedTuple
+
+from line_protocol import FIELD_TYPES, MISSING_INT
+
+# Array type of each column: 64-bit integers and doubles, 8 bytes per night either way
+_TYPECODES: dict[type, str] = {int: "q", float: "d"}
+_MISSING: dict[type, int | float] = {int: MISSING_INT, float: float("nan")}
+_COLUMNS: tuple[tuple[str, type], ...] = tuple(FIELD_TYPES.items())
+_COLUMN_NAMES = frozenset(FIELD_TYPES)
+_COLUMN_INDEXES: dict[str, int] = {name: index for index, name in enumerate(FIELD_TYPES)}
+
+
+class Series(NamedTuple):
+    """Measurement and tag set shared by all the nights of a device (see series())"""
+
+    measurement: str
+    tags: dict[str, str]
+
+
+@lru_cache(maxsize=1024)
+def _series(measurement: str, tags: tuple) -> Series:
+    return Series(measurement, dict(tags))
+
+
+def series(measurement: str, tags: dict[str, str]) -> Series:
+    """The one Series object of this measurement and tag set: nights of the same device share it (compare with is)"""
+    return _series(measurement, tuple(sorted(tags.items())))
+
+
+class Night:
+    """
+    One night of a series, with a slot per field of FIELD_TYPES (None when myAir did not send it).
+    Reads like the point dicts it replaces: night["time"], night["fields"], night["tags"], night["measurement"].
+    """
+
+    __slots__ = ("series", "time", "extra", *FIELD_TYPES)
+
+    def __init__(self, series: Series, time: str, values: Mapping, extra: dict | None = None) -> None:
+        self.series: Series = series
+        # startDate, %Y-%m-%d
+        self.time: str = time
+        # Fields that are not in FIELD_TYPES, if any
+        self.extra: dict | None = extra
+        for name, kind in _COLUMNS:
+            value = values.get(name)
+            setattr(self, name, None if value is None else kind(value))
+
+    @property
+    def fields(self) -> dict:
+        fields = {name: value for name in FIELD_TYPES if (value := getattr(self, name)) is not None}
+        if self.extra:
+            fields.update(self.extra)
+        return fields
+
+    def __getitem__(self, key: str):
+        if key == "time":
+            return self.time
+        if key == "fields":
+            return self.fields
+        if key == "tags":
+            return self.series.tags
+        if key == "measurement":
+            return self.series.measurement
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        return {"measurement": self.series.measurement, "tags": self.series.tags, "fields": self.fields, "time": self.time}
+
+    def __repr__(self) -> str:
+        return f"Night({self.time}, {self.fields})"
+
+
+class NightBatch:
+    """
+    Nights of one series, stored column by column: a typed array per field of FIELD_TYPES and a list of startDates.
+    Missing values are MISSING_INT in integer columns, NaN in float columns. Fields outside FIELD_TYPES
+    (myAir does not send any today) are kept per night in extra.
+    LineSerializer.batch_lines writes it without building a point per night;
+    for other consumers it is a sequence of Night, which read like point dicts.
+    """
+
+    __slots__ = ("series", "times", "columns", "extra")
+
+    def __init__(self, series: Series) -> None:
+        self.series: Series = series
+        self.times: list[str] = []
+        # In FIELD_TYPES order
+        self.columns: tuple[array, ...] = tuple(array(_TYPECODES[kind]) for _, kind in _COLUMNS)
+        # Index of the night: its fields that are not in FIELD_TYPES
+        self.extra: dict[int, dict] = {}
+
+    def append(self, time: str, values: Mapping, ignore: Collection[str] = ()) -> None:
+        """Add a night from a mapping of its fields (such as a sleep record), ignoring the keys in ignore"""
+        for (name, kind), column in zip(_COLUMNS, self.columns):
+            value = values.get(name)
+            column.append(_MISSING[kind] if value is None else kind(value))
+        if not values.keys() <= _COLUMN_NAMES:
+            extra = {k: v for k, v in values.items() if k not in _COLUMN_NAMES and k not in ignore}
+            if extra:
+                self.extra[len(self.times)] = extra
+        self.times.append(time)
+
+    def select(self, indexes: list[int]) -> "NightBatch":
+        """The nights at the given indexes, as a new batch"""
+        ret = NightBatch(self.series)
+        ret.times = [self.times[i] for i in indexes]
+        ret.columns = tuple(array(column.typecode, [column[i] for i in indexes]) for column in self.columns)
+        ret.extra = {new: self.extra[old] for new, old in enumerate(indexes) if old in self.extra}
+        return ret
+
+    def times_with(self, name: str) -> list[str]:
+        """startDates of the nights that have a value for the field name (of FIELD_TYPES)"""
+        column = self.columns[_COLUMN_INDEXES[name]]
+        return [time for time, value in zip(self.times, column) if value == value and value != MISSING_INT]
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def __getitem__(self, index: int) -> Night:
+        if index < 0:
+            index += len(self.times)
+        values = {}
+        for (name, kind), column in zip(_COLUMNS, self.columns):
+            value = column[index]
+            if value == value and value != MISSING_INT:
+                values[name] = value
+        return Night(self.series, self.times[index], values, self.extra.get(index))
+
+    def __iter__(self) -> Iterator[Night]:
+        return (self[index] for index in range(len(self.times)))
+
+    def to_dicts(self) -> list[dict]:
+        return [night.to_dict() for night in self]
@@ -0,0 +1,190 @@
+from datetime import datetime, timedelta, tzinfo
+import logging
+
+try:
+    import numpy
+except ImportError:  # Optional: rolling statistics are not written without it
+    numpy = None
+
+from line_protocol import FIELD_TYPES, MISSING_INT, LineSerializer
+from nights import NightBatch, Series
+
+# Fields averaged over each window, written as <field>_<days>d (e.g. ahi_30d)
+AVERAGED_FIELDS = ("ahi", "totalUsage", "leakPercentile", "sleepScore")
+# Windows, in days, written as <field>_<days>d and compliance_<days>d
+WINDOWS_DAYS = (7, 30, 90)
+# Days of values kept per device between syncs: enough for the windows of the nights imported again
+KEEP_DAYS = 2 * max(WINDOWS_DAYS)
+
+_MAX_WINDOW = max(WINDOWS_DAYS)
+_COLUMN_INDEXES = tuple(list(FIELD_TYPES).index(name) for name in AVERAGED_FIELDS)
+_USAGE = AVERAGED_FIELDS.index("totalUsage")
+
+
+def create_rolling_stats(influx_conf: dict, tz: tzinfo) -> "RollingStats | None":
+    """The RollingStats configured in [influx], or None when disabled (or numpy is missing)"""
+    measurement = influx_conf["rolling_measurement"]
+    if not measurement:
+        return None
+    if numpy is None:
+        logging.warning("influx.rolling_measurement is set but numpy is not installed: rolling statistics are not written.")
+        return None
+    return RollingStats(measurement, influx_conf["compliance_minutes"], tz)
+
+
+def _day(start_date: str) -> int:
+    """Days since the epoch of a startDate (%Y-%m-%d)"""
+    return int(numpy.datetime64(start_date, "D").astype(numpy.int64))
+
+
+class _Window:
+    """Values of AVERAGED_FIELDS of one device, one row per day from origin (NaN for days without a night)"""
+
+    __slots__ = ("origin", "values", "first_night", "series", "serializer")
+
+    def __init__(self, origin: int) -> None:
+        self.origin: int = origin
+        self.values = numpy.full((0, len(AVERAGED_FIELDS)), numpy.nan)
+        # First day with a night: days before it do not count in the compliance rates
+        self.first_night: int | None = None
+        self.series: Series | None = None
+        self.serializer: LineSerializer | None = None
+
+    @property
+    def end(self) -> int:
+        """Day after the last row"""
+        return self.origin + len(self.values)
+
+    def store(self, days, rows) -> None:
+        """Set the rows of the given days, growing the window as needed"""
+        origin, end = min(self.origin, int(days.min())), max(self.end, int(days.max()) + 1)
+        if (origin, end) != (self.origin, self.end):
+            values = numpy.full((end - origin, len(AVERAGED_FIELDS)), numpy.nan)
+            values[self.origin - origin : self.end - origin] = self.values
+            self.origin, self.values = origin, values
+        self.values[days - self.origin] = rows
+        present = days[~numpy.isnan(rows).all(axis=1)]
+        if len(present):
+            first = int(present.min())
+            self.first_night = first if self.first_night is None else min(self.first_night, first)
+
+    def trim(self, days: int) -> None:
+        """Only keep the last days"""
+        if len(self.values) > days:
+            self.origin += len(self.values) - days
+            self.values = self.values[-days:].copy()
+
+
+class RollingStats:
+    """
+    Moving averages of AVERAGED_FIELDS and compliance rates over the last WINDOWS_DAYS days of each device,
+    computed (with numpy) as the nights are imported and written to a separate measurement, one point per night,
+    so that dashboards read them instead of aggregating the raw nights at query time.
+    The compliance rate is the share of the days of the window with at least compliance_minutes of use
+    (days without a night count as not compliant; days before the first known night are not counted).
+    Only the windows of the nights that changed are computed again, from the values kept per device.
+    """
+
+    def __init__(self, measurement: str, compliance_minutes: int, tz: tzinfo) -> None:
+        self.measurement: str = measurement
+        self._compliance_minutes: int = compliance_minutes
+        self._tz: tzinfo = tz
+        self._windows: dict[str, _Window] = {}
+
+    def seed_since(self, serial_number: str, since: datetime) -> datetime | None:
+        """
+        When importing nights from since, the time from which the device's nights must be read from influx
+        (for the windows of the first nights), or None if they are already known
+        """
+        window = self._windows.get(serial_number)
+        first = since - timedelta(days=_MAX_WINDOW)
+        if window and window.origin <= _day(first.strftime("%Y-%m-%d")):
+            return None
+        return first
+
+    def seed(self, serial_number: str, since: datetime, nights: list[tuple[str, dict]]) -> None:
+        """Start the device's window with the nights already in influx, read from since"""
+        window = self._windows[serial_number] = _Window(_day(since.strftime("%Y-%m-%d")))
+        if not nights:
+            return
+        days = numpy.array([_day(start_date) for start_date, _ in nights])
+        rows = numpy.array(
+            [[fields.get(name, numpy.nan) for name in AVERAGED_FIELDS] for _, fields in nights], dtype=float
+        )
+        window.store(days, rows)
+
+    def update(self, serial_number: str, nights: NightBatch, changed: NightBatch) -> list[bytes]:
+        """
+        Add imported nights (all of them, changed or not) to the device's window;
+        line protocol of the statistics of the nights whose windows include a changed night
+        """
+        if not nights:
+            return []
+        window = self._windows.get(serial_number)
+        if window is None:
+            window = self._windows[serial_number] = _Window(_day(nights.times[0]))
+        days = numpy.array(nights.times, dtype="datetime64[D]").astype(numpy.int64)
+        rows = numpy.empty((len(nights), len(AVERAGED_FIELDS)))
+        for column, index in enumerate(_COLUMN_INDEXES):
+            values = numpy.frombuffer(nights.columns[index], dtype=nights.columns[index].typecode).astype(float)
+            if nights.columns[index].typecode == "q":
+                values[values == MISSING_INT] = numpy.nan
+            rows[:, column] = values
+        window.store(days, rows)
+        if not changed:
+            return []
+
+        # A night is in the windows of the _MAX_WINDOW days from it
+        changed_days = [_day(start_date) for start_date in changed.times]
+        start, end = min(changed_days), min(max(changed_days) + _MAX_WINDOW, window.end)
+        if nights.series is not window.series:
+            window.series = nights.series
+            window.serializer = LineSerializer(self.measurement, nights.series.tags, self._tz)
+        return window.serializer.lines(self._points(window, start, end))
+
+    def trim(self, serial_number: str) -> None:
+        """Once a sync is over: only keep the values needed by the next ones"""
+        window = self._windows.get(serial_number)
+        if window:
+            window.trim(KEEP_DAYS)
+
+    def forget(self, serial_number: str) -> None:
+        self._windows.pop(serial_number, None)
+
+    def _points(self, window: _Window, start: int, end: int) -> list[dict]:
+        """Statistics of the days from start to end (excluded) that have a night, as points"""
+        # The rows of the days of the windows, preceded by a row of zeros for the cumulative sums
+        low = max(start - _MAX_WINDOW + 1, window.origin)
+        values = window.values[low - window.origin : end - window.origin]
+        present = ~numpy.isnan(values)
+        sums = numpy.zeros((len(values) + 1, len(AVERAGED_FIELDS)))
+        numpy.cumsum(numpy.where(present, values, 0), axis=0, out=sums[1:])
+        counts = numpy.zeros((len(values) + 1, len(AVERAGED_FIELDS)))
+        numpy.cumsum(present, axis=0, out=counts[1:])
+        compliant = numpy.zeros(len(values) + 1)
+        numpy.cumsum(values[:, _USAGE] >= self._compliance_minutes, out=compliant[1:])
+
+        # Rows (in values) of the days to write: those with a night
+        rows = numpy.arange(start - low, end - low)
+        rows = rows[present[rows].any(axis=1)]
+        if not len(rows):
+            return []
+        days = rows + low
+        stats: dict[str, numpy.ndarray] = {}
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            for length in WINDOWS_DAYS:
+                first = numpy.maximum(rows + 1 - length, 0)
+                means = (sums[rows + 1] - sums[first]) / (counts[rows + 1] - counts[first])
+                for column, name in enumerate(AVERAGED_FIELDS):
+                    stats[f"{name}_{length}d"] = means[:, column]
+                known = numpy.minimum(length, days - window.first_night + 1)
+                stats[f"compliance_{length}d"] = (compliant[rows + 1] - compliant[first]) / known
+
+        dates = numpy.datetime_as_string(days.astype("datetime64[D]"))
+        return [
+            {
+                "fields": {name: round(float(stat[index]), 3) for name, stat in stats.items() if stat[index] == stat[index]},
+                "time": str(dates[index]),
+            }
+            for index in range(len(rows))
+        ]
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import math
+import random
+import time
+
+from state import StateStore
+
+MINUTES_PER_DAY = 24 * 60
+# Uploads needed before an account's upload time is trusted; until then it is polled every max_interval
+MIN_HISTORY = 3
+# Polls are dense this many minutes (at least) on each side of the usual upload time
+MIN_SPREAD_MINUTES = 30
+MAX_SPREAD_MINUTES = 180
+# A night counts as imported for the day when the device uploaded this recently
+INGESTED_HOURS = 20
+# Longest wait between two polls once the night is imported
+MAX_BACKOFF_SECONDS = 6 * 3600
+# Each wait is randomly stretched or shortened by up to this fraction so that accounts do not poll in lockstep
+JITTER = 0.1
+
+
+def parse_report_time(report_time: str | None) -> datetime | None:
+    """lastSleepDataReportTime as an aware datetime, None if missing or not in the expected ISO format"""
+    if not report_time:
+        return None
+    try:
+        parsed = datetime.fromisoformat(report_time.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def upload_window(minutes: list[int]) -> tuple[int, int]:
+    """(center, spread) in minutes of the day (UTC) of a list of upload times, wrapping around midnight"""
+    angles = [2 * math.pi * m / MINUTES_PER_DAY for m in minutes]
+    mean = math.atan2(sum(math.sin(a) for a in angles), sum(math.cos(a) for a in angles))
+    center = round(mean * MINUTES_PER_DAY / (2 * math.pi)) % MINUTES_PER_DAY
+    deviations = sorted(circular_distance(m, center) for m in minutes)
+    # Ignore the odd late upload (e.g. a nap, or a device out of range for a day)
+    typical = deviations[int(len(deviations) * 0.8) - 1] if len(deviations) >= 5 else deviations[-1]
+    return center, min(MAX_SPREAD_MINUTES, max(MIN_SPREAD_MINUTES, typical))
+
+
+def circular_distance(a: int, b: int) -> int:
+    d = abs(a - b) % MINUTES_PER_DAY
+    return min(d, MINUTES_PER_DAY - d)
+
+
+class _AccountSchedule:
+    def __init__(self, uploads: list[str]) -> None:
+        self.uploads: list[str] = uploads
+        self.last_report_time: str | None = uploads[-1] if uploads else None
+        # Polls since the last upload that found nothing new
+        self.idle_polls: int = 0
+        self.next_poll: float = 0
+
+
+class PollScheduler:
+    """
+    When to poll each account next. A device uploads about once a day, shortly after the user wakes up:
+    the scheduler learns the usual time of day of each account's lastSleepDataReportTime and polls every
+    min_interval around it until the night is imported, then backs off exponentially until the next window.
+    Accounts without enough history yet (and accounts whose night is late) are polled every max_interval.
+    """
+
+    # Upload times kept per account
+    HISTORY = 14
+
+    def __init__(self, state: StateStore, min_interval: float, max_interval: float) -> None:
+        self._state = state
+        self._min_interval: float = min_interval
+        self._max_interval: float = max(min_interval, max_interval)
+        self._accounts: dict[str, _AccountSchedule] = {}
+
+    def start(self, keys: list[str]) -> None:
+        """Schedule the first poll of each account, spread over min_interval"""
+        now = time.time()
+        for key in keys:
+            account = _AccountSchedule(self._state.get_uploads(key, self.HISTORY))
+            account.next_poll = now + random.uniform(0, self._min_interval)
+            self._accounts[key] = account
+
+    def due(self, now: float | None = None) -> list[str]:
+        now = time.time() if now is None else now
+        return [key for key, account in self._accounts.items() if account.next_poll <= now]
+
+    def next_poll(self) -> float:
+        """Epoch seconds of the earliest scheduled poll"""
+        return min((account.next_poll for account in self._accounts.values()), default=time.time() + self._max_interval)
+
+    def done(self, key: str, report_time: str | None, ok: bool, now: float | None = None) -> float:
+        """Record the outcome of a poll and schedule the next one; returns the wait in seconds"""
+        now = time.time() if now is None else now
+        account = self._accounts[key]
+        if ok and report_time and report_time != account.last_report_time:
+            account.last_report_time = report_time
+            account.idle_polls = 0
+            if parse_report_time(report_time):
+                account.uploads = (account.uploads + [report_time])[-self.HISTORY :]
+                self._state.add_upload(key, report_time, self.HISTORY)
+        else:
+            account.idle_polls += 1
+        wait = self.interval(account, datetime.fromtimestamp(now, timezone.utc)) if ok else self._max_interval
+        wait *= random.uniform(1 - JITTER, 1 + JITTER)
+        account.next_poll = now + wait
+        logging.debug(f"Next poll of {key[:8]} in {wait / 60:.0f} minute(s).")
+        return wait
+
+    def interval(self, account: _AccountSchedule, now: datetime) -> float:
+        uploads = [t for t in (parse_report_time(u) for u in account.uploads) if t]
+        if len(uploads) < MIN_HISTORY:
+            return self._max_interval
+        center, spread = upload_window([t.hour * 60 + t.minute for t in uploads])
+        minute = now.hour * 60 + now.minute
+        until_window = ((center - spread - minute) % MINUTES_PER_DAY) * 60
+
+        last_upload = parse_report_time(account.last_report_time)
+        if last_upload and now - last_upload < timedelta(hours=INGESTED_HOURS):
+            # Tonight's data is in: back off, but be there when the next window opens
+            backoff = min(MAX_BACKOFF_SECONDS, self._min_interval * 2 ** account.idle_polls)
+            return max(self._min_interval, min(backoff, until_window))
+        if circular_distance(minute, center) <= spread:
+            return self._min_interval
+        return max(self._min_interval, min(self._max_interval, until_window))
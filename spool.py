@@ -0,0 +1,122 @@
+import logging
+import os
+from pathlib import Path
+import threading
+import zlib
+
+from storage import FILE_MODE
+
+# A segment being appended to is sealed (made available for draining) once it reaches this size
+SEGMENT_BYTES = 4 * 1024 * 1024
+OPEN_SUFFIX = ".open"
+SEALED_SUFFIX = ".lp"
+
+
+class Spool:
+    """
+    Append-only queue of points on disk, in line protocol (second precision), one folder per destination (influx bucket):
+    points are fsynced to a segment file before being reported as written, and removed once in influx.
+    Each line carries a CRC32 so that a line torn by a crash is detected and skipped.
+    When over max_bytes, the oldest segments are dropped.
+    Thread-safe: called from worker threads so that fsync does not block the event loop.
+    """
+
+    def __init__(self, folder: str | Path, max_bytes: int) -> None:
+        self._folder = Path(folder)
+        self._folder.mkdir(parents=True, exist_ok=True)
+        self._max_bytes: int = max_bytes
+        self._lock = threading.Lock()
+        self._active: dict[str, tuple[Path, int]] = {}
+        # Segments left open by a previous run are complete up to their last intact line
+        for path in self._folder.glob(f"*/*{OPEN_SUFFIX}"):
+            path.rename(path.with_suffix(SEALED_SUFFIX))
+        segments = self.__all_segments()
+        self._size: int = sum(path.stat().st_size for path in segments)
+        self._next_seq: int = max((int(path.stem) for path in segments), default=0) + 1
+        if segments:
+            logging.info(f"Found {len(segments)} spooled segment(s) ({self._size / 1024:.0f} KiB) waiting to be written to influx.")
+
+    def append(self, key: str, lines: list[bytes]) -> None:
+        data = b"".join(b"%08x %s\n" % (zlib.crc32(line), line) for line in lines)
+        with self._lock:
+            path, size = self._active.get(key) or self.__new_segment(key)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, FILE_MODE)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._size += len(data)
+            self._active[key] = (path, size + len(data))
+            if size + len(data) >= SEGMENT_BYTES:
+                self.__seal(key)
+            self.__evict()
+
+    def seal(self) -> None:
+        """Make everything appended so far available to segments()"""
+        with self._lock:
+            for key in list(self._active):
+                self.__seal(key)
+
+    def has_pending(self, key: str) -> bool:
+        """Whether points of the destination are still waiting to be written to influx"""
+        return key in self._active or bool(self.segments(key))
+
+    def keys(self) -> list[str]:
+        return sorted(path.name for path in self._folder.iterdir() if path.is_dir())
+
+    def segments(self, key: str) -> list[Path]:
+        """Sealed segments of the destination, oldest first"""
+        return sorted((self._folder / key).glob(f"*{SEALED_SUFFIX}"))
+
+    def read(self, segment: Path) -> list[bytes]:
+        lines, corrupt = [], 0
+        with open(segment, "rb") as f:
+            for raw in f:
+                crc, _, line = raw.rstrip(b"\n").partition(b" ")
+                if raw.endswith(b"\n") and crc == b"%08x" % zlib.crc32(line):
+                    lines.append(line)
+                else:
+                    corrupt += 1
+        if corrupt:
+            logging.warning(f"Skipping {corrupt} corrupt line(s) in spool segment {segment.name}.")
+        return lines
+
+    def remove(self, segment: Path) -> None:
+        with self._lock:
+            self.__remove(segment)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def __new_segment(self, key: str) -> tuple[Path, int]:
+        folder = self._folder / key
+        folder.mkdir(exist_ok=True)
+        path = folder / f"{self._next_seq:012d}{OPEN_SUFFIX}"
+        self._next_seq += 1
+        return path, 0
+
+    def __seal(self, key: str) -> None:
+        path, _ = self._active.pop(key)
+        path.rename(path.with_suffix(SEALED_SUFFIX))
+
+    def __remove(self, segment: Path) -> None:
+        try:
+            size = segment.stat().st_size
+            segment.unlink()
+        except FileNotFoundError:
+            return
+        self._size -= size
+
+    def __all_segments(self) -> list[Path]:
+        return sorted(self._folder.glob(f"*/*{SEALED_SUFFIX}"), key=lambda path: path.stem)
+
+    def __evict(self) -> None:
+        if self._size <= self._max_bytes:
+            return
+        for segment in self.__all_segments():
+            logging.warning(f"Spool over {self._max_bytes / 1024 / 1024:.0f} MiB: dropping its oldest segment {segment.parent.name}/{segment.name}.")
+            self.__remove(segment)
+            if self._size <= self._max_bytes:
+                return
@@ -0,0 +1,197 @@
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
+from pathlib import Path
+import sqlite3
+import time
+from typing import NamedTuple
+
+from nights import NightBatch
+from storage import connect_shared_sqlite
+
+
+class HighWaterMark(NamedTuple):
+    """What was last imported for a device"""
+
+    serial_number: str
+    # startDate (%Y-%m-%d) of the most recent night written to influx
+    last_start_date: str | None
+    # lastSleepDataReportTime of the device when it was last imported
+    last_report_time: str | None
+    # epoch seconds of the last time the state was cross-checked with influx
+    checked_at: float
+
+
+class StateStore:
+    """
+    Durable import state, kept in SQLite in the data folder (or in memory when there is none).
+    Keyed by account and device serial number.
+    """
+
+    def __init__(self, folder: str | Path | None) -> None:
+        if folder:
+            self._db = connect_shared_sqlite(Path(folder) / "state.sqlite")
+        else:
+            logging.info("No data folder configured: import state will not survive a restart.")
+            self._db = sqlite3.connect(":memory:")
+        with self._db:
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS high_water_marks (
+                    account TEXT NOT NULL,
+                    serial_number TEXT NOT NULL,
+                    last_start_date TEXT,
+                    last_report_time TEXT,
+                    checked_at REAL NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (account, serial_number)
+                )"""
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS night_digests (
+                    serial_number TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    PRIMARY KEY (serial_number, start_date)
+                )"""
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS uploads (
+                    account TEXT NOT NULL,
+                    report_time TEXT NOT NULL,
+                    PRIMARY KEY (account, report_time)
+                )"""
+            )
+
+    def get(self, account: str) -> HighWaterMark | None:
+        """State of the device of the account that was imported most recently"""
+        row = self._db.execute(
+            "SELECT serial_number, last_start_date, last_report_time, checked_at FROM high_water_marks "
+            "WHERE account = ? ORDER BY updated_at DESC LIMIT 1",
+            (account,),
+        ).fetchone()
+        return HighWaterMark(*row) if row else None
+
+    def update(
+        self, account: str, serial_number: str, last_start_date: str | None, last_report_time: str | None, checked: bool = False
+    ) -> None:
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                """INSERT INTO high_water_marks (account, serial_number, last_start_date, last_report_time, checked_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (account, serial_number) DO UPDATE SET
+                       last_start_date = COALESCE(excluded.last_start_date, last_start_date),
+                       last_report_time = COALESCE(excluded.last_report_time, last_report_time),
+                       checked_at = CASE WHEN excluded.checked_at > 0 THEN excluded.checked_at ELSE checked_at END,
+                       updated_at = excluded.updated_at""",
+                (account, serial_number, last_start_date, last_report_time, now if checked else 0, now),
+            )
+
+    def get_digests(self, serial_number: str) -> dict[str, str]:
+        rows = self._db.execute(
+            "SELECT start_date, digest FROM night_digests WHERE serial_number = ?", (serial_number,)
+        ).fetchall()
+        return dict(rows)
+
+    def put_digests(self, serial_number: str, digests: dict[str, str], keep_since: str) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO night_digests (serial_number, start_date, digest) VALUES (?, ?, ?)",
+                [(serial_number, start_date, digest) for start_date, digest in digests.items()],
+            )
+            # Nights older than the import window are never compared again
+            self._db.execute(
+                "DELETE FROM night_digests WHERE serial_number = ? AND start_date < ?", (serial_number, keep_since)
+            )
+
+    def delete_digests(self, serial_number: str) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM night_digests WHERE serial_number = ?", (serial_number,))
+
+    def get_uploads(self, account: str, limit: int) -> list[str]:
+        """The most recent lastSleepDataReportTime seen for the account, oldest first"""
+        rows = self._db.execute(
+            "SELECT report_time FROM uploads WHERE account = ? ORDER BY report_time DESC LIMIT ?", (account, limit)
+        ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def add_upload(self, account: str, report_time: str, keep: int) -> None:
+        with self._db:
+            self._db.execute("INSERT OR IGNORE INTO uploads (account, report_time) VALUES (?, ?)", (account, report_time))
+            self._db.execute(
+                "DELETE FROM uploads WHERE account = ? AND report_time NOT IN "
+                "(SELECT report_time FROM uploads WHERE account = ? ORDER BY report_time DESC LIMIT ?)",
+                (account, account, keep),
+            )
+
+    def close(self) -> None:
+        self._db.close()
+
+    @staticmethod
+    def to_datetime(start_date: str) -> datetime:
+        """
+        startDate is at daily precision: the day, as midnight UTC.
+        Influx stores the night at midnight in influx.timezone (see line_protocol.night_timestamp)
+        """
+        return datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+
+def fields_digest(fields: dict) -> str:
+    """Digest of the field values of a night, identical whether the values come from myAir or from influx"""
+    canonical = "|".join(
+        f"{k}={float(v)!r}" if isinstance(v, (int, float)) and not isinstance(v, bool) else f"{k}={v!r}"
+        for k, v in sorted(fields.items())
+        if v is not None
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class DigestIndex:
+    """
+    Digest of the fields of every recently imported night, per device, so that nights
+    that did not change since they were written are not written again.
+    Kept in memory, persisted in the StateStore.
+    """
+
+    # Digests of nights older than this (relative to the most recent night imported) are dropped
+    RETENTION_DAYS = 62
+
+    def __init__(self, store: StateStore) -> None:
+        self._store = store
+        self._digests: dict[str, dict[str, str]] = {}
+
+    def is_loaded(self, serial_number: str) -> bool:
+        """Load the device's persisted digests on first use; False if there are none"""
+        if serial_number not in self._digests:
+            self._digests[serial_number] = self._store.get_digests(serial_number)
+            return bool(self._digests[serial_number])
+        return True
+
+    def forget(self, serial_number: str) -> None:
+        """Drop what is known about the device, e.g. when influx lost data"""
+        self._digests.pop(serial_number, None)
+        self._store.delete_digests(serial_number)
+
+    def seed(self, serial_number: str, nights: list[tuple[str, dict]]) -> None:
+        """Bulk-load the digests of nights already in influx"""
+        digests = {start_date: fields_digest(fields) for start_date, fields in nights}
+        self._digests.setdefault(serial_number, {}).update(digests)
+        self._store.put_digests(serial_number, digests, "")
+
+    def changed(self, serial_number: str, points: NightBatch | list[dict]) -> NightBatch | list[dict]:
+        known = self._digests.get(serial_number, {})
+        changed = [index for index, point in enumerate(points) if known.get(point["time"]) != fields_digest(point["fields"])]
+        return points.select(changed) if isinstance(points, NightBatch) else [points[index] for index in changed]
+
+    def commit(self, serial_number: str, points: NightBatch | list[dict]) -> None:
+        """Remember points once they are written"""
+        if not points:
+            return
+        digests = {point["time"]: fields_digest(point["fields"]) for point in points}
+        known = self._digests.setdefault(serial_number, {})
+        known.update(digests)
+        # Only recent nights are imported again: keeping the digests of a whole backfill would only use memory
+        keep_since = (datetime.strptime(max(known), "%Y-%m-%d") - timedelta(days=self.RETENTION_DAYS)).strftime("%Y-%m-%d")
+        for start_date in [d for d in known if d < keep_since]:
+            del known[start_date]
+        self._store.put_digests(serial_number, {d: v for d, v in digests.items() if d >= keep_since}, keep_since)
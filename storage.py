@@ -0,0 +1,23 @@
+import os
+from pathlib import Path
+import sqlite3
+
+# Files written to the data folder (tokens, import state, spooled points): only the owner may read or write them
+FILE_MODE = 0o600
+
+
+def create_private_file(path: Path) -> None:
+    """Create the file (and its folder) if needed, readable by the owner only"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not path.exists():
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, FILE_MODE))
+    os.chmod(path, FILE_MODE)
+
+
+def connect_shared_sqlite(path: Path) -> sqlite3.Connection:
+    """Connection to a private SQLite database that several worker processes may use at the same time"""
+    create_private_file(path)
+    db = sqlite3.connect(path, timeout=30)
+    # Several worker processes may share the file: readers don't block the writer
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
@@ -0,0 +1,123 @@
+from collections.abc import Callable
+import logging
+import multiprocessing
+from multiprocessing.process import BaseProcess
+import signal
+import time
+
+from fleet import account_configs
+
+# How often the supervisor checks on its workers
+POLL_SECONDS = 5
+# How often the config is reloaded to detect added / removed accounts
+RELOAD_SECONDS = 60
+# Time given to workers to flush their data when stopping, before they are killed
+STOP_TIMEOUT_SECONDS = 30
+# Delay before restarting a worker that crashed, doubled for each crash in a row (capped)
+RESTART_DELAY_SECONDS = 5
+MAX_RESTART_DELAY_SECONDS = 300
+
+
+class Supervisor:
+    """
+    Runs the fleet in several worker processes, each with its own event loop and its own shard of the accounts
+    (see fleet.shard_of). Crashed workers are restarted, and all workers are restarted with the new
+    account list when it changes in the config.
+    """
+
+    def __init__(self, load_config: Callable[[], dict], worker: Callable[[dict, tuple[int, int]], None], count: int) -> None:
+        self._load_config = load_config
+        self._worker = worker
+        self._count: int = count
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: list[BaseProcess | None] = [None] * count
+        self._crashes: list[int] = [0] * count
+        self._restart_at: list[float] = [0] * count
+        self._started_at: list[float] = [0] * count
+        self._stopping: bool = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.__on_stop)
+        config = self._load_config()
+        accounts = account_configs(config)
+        logging.info(f"Starting {self._count} worker(s) for {len(accounts)} account(s).")
+        for index in range(self._count):
+            self.__start(index, config)
+
+        reload_at = time.monotonic() + RELOAD_SECONDS
+        try:
+            while not self._stopping:
+                time.sleep(POLL_SECONDS)
+                if self.__all_done():
+                    logging.info("All workers completed.")
+                    return
+                self.__restart_crashed(config)
+                if time.monotonic() >= reload_at:
+                    reload_at = time.monotonic() + RELOAD_SECONDS
+                    new_config = self.__reload(accounts)
+                    if new_config:
+                        config = new_config
+                        accounts = account_configs(config)
+                        logging.info(f"Account list changed ({len(accounts)} account(s)). Rebalancing workers.")
+                        self.__stop_all()
+                        for index in range(self._count):
+                            self.__start(index, config)
+        except KeyboardInterrupt:
+            # Ctrl-C also reached the workers, which are stopping on their own
+            pass
+        finally:
+            self.__stop_all()
+
+    def __on_stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def __start(self, index: int, config: dict) -> None:
+        process = self._context.Process(
+            target=self._worker, args=(config, (index, self._count)), name=f"worker-{index}", daemon=False
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def __all_done(self) -> bool:
+        # In run-once mode (loop_minutes = 0) workers exit on their own when done
+        return all(p is not None and not p.is_alive() and p.exitcode == 0 for p in self._processes)
+
+    def __restart_crashed(self, config: dict) -> None:
+        now = time.monotonic()
+        for index, process in enumerate(self._processes):
+            if process is None or process.is_alive() or process.exitcode == 0:
+                continue
+            if not self._restart_at[index]:
+                self._crashes[index] += 1
+                delay = min(MAX_RESTART_DELAY_SECONDS, RESTART_DELAY_SECONDS * 2 ** (self._crashes[index] - 1))
+                logging.error(f"{process.name} exited with code {process.exitcode}. Restarting in {delay}s.")
+                self._restart_at[index] = now + delay
+            elif now >= self._restart_at[index]:
+                self._restart_at[index] = 0
+                self.__start(index, config)
+        # A worker that stayed up for a while is considered healthy again
+        for index, process in enumerate(self._processes):
+            if process and process.is_alive() and now - self._started_at[index] > MAX_RESTART_DELAY_SECONDS:
+                self._crashes[index] = 0
+
+    def __reload(self, accounts: list[dict]) -> dict | None:
+        """The new config if the account list changed, None otherwise"""
+        try:
+            config = self._load_config()
+        except Exception as e:
+            logging.warning(f"Unable to reload config. {e.__class__.__qualname__}: {e}")
+            return None
+        return config if account_configs(config) != accounts else None
+
+    def __stop_all(self) -> None:
+        running = [p for p in self._processes if p is not None and p.is_alive()]
+        for process in running:
+            process.terminate()  # SIGTERM: the worker flushes pending points and exits
+        deadline = time.monotonic() + STOP_TIMEOUT_SECONDS
+        for process in running:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop in time. Killing it.")
+                process.kill()
+                process.join()
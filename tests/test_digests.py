@@ -0,0 +1,66 @@
+from datetime import date, timedelta
+
+from nights import NightBatch, series
+from state import DigestIndex, StateStore
+
+SERIAL = "23201234567"
+
+
+def nights(first: str, count: int, ahi: float = 1.5) -> NightBatch:
+    batch = NightBatch(series("sleep", {"serialNumber": SERIAL}))
+    start = date.fromisoformat(first)
+    for day in range(count):
+        batch.append((start + timedelta(days=day)).isoformat(), {"totalUsage": 420 + day, "ahi": ahi})
+    return batch
+
+
+def test_unknown_nights_are_changed():
+    index = DigestIndex(StateStore(None))
+    assert not index.is_loaded(SERIAL)
+    changed = index.changed(SERIAL, nights("2026-10-01", 3))
+    assert isinstance(changed, NightBatch)
+    assert changed.times == ["2026-10-01", "2026-10-02", "2026-10-03"]
+
+
+def test_only_modified_nights_are_changed_once_committed():
+    index = DigestIndex(StateStore(None))
+    index.commit(SERIAL, nights("2026-10-01", 3))
+    assert len(index.changed(SERIAL, nights("2026-10-01", 3))) == 0
+    assert len(index.changed(SERIAL, nights("2026-10-01", 3, ahi=2.5))) == 3
+
+    # A night with a field it did not have, and a new night
+    points = [
+        {"time": "2026-10-01", "fields": {"totalUsage": 420, "ahi": 1.5}},
+        {"time": "2026-10-02", "fields": {"totalUsage": 421, "ahi": 1.5, "sleepScore": 80}},
+        {"time": "2026-10-04", "fields": {"totalUsage": 423, "ahi": 1.5}},
+    ]
+    assert [point["time"] for point in index.changed(SERIAL, points)] == ["2026-10-02", "2026-10-04"]
+
+
+def test_nights_read_back_from_influx_are_unchanged():
+    index = DigestIndex(StateStore(None))
+    # Influx returns every value as a float
+    index.seed(SERIAL, [("2026-10-01", {"totalUsage": 420.0, "ahi": 1.5})])
+    assert len(index.changed(SERIAL, nights("2026-10-01", 1))) == 0
+
+
+def test_digests_are_persisted_and_forgotten():
+    store = StateStore(None)
+    DigestIndex(store).commit(SERIAL, nights("2026-10-01", 3))
+
+    index = DigestIndex(store)
+    assert index.is_loaded(SERIAL)
+    assert len(index.changed(SERIAL, nights("2026-10-01", 3))) == 0
+
+    index.forget(SERIAL)
+    assert len(index.changed(SERIAL, nights("2026-10-01", 3))) == 3
+    assert not DigestIndex(store).is_loaded(SERIAL)
+
+
+def test_old_digests_are_dropped():
+    store = StateStore(None)
+    index = DigestIndex(store)
+    index.commit(SERIAL, nights("2026-01-01", 200))
+    kept = store.get_digests(SERIAL)
+    assert min(kept) == (date(2026, 1, 1) + timedelta(days=199 - DigestIndex.RETENTION_DAYS)).isoformat()
+    assert len(kept) == DigestIndex.RETENTION_DAYS + 1
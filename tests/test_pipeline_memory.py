@@ -0,0 +1,20 @@
+import asyncio
+
+import pytest
+
+from benchmarks.pipeline_memory import CEILING_MIB, GROWTH_FACTOR, YEARS, sync_peak
+
+
+@pytest.fixture(scope="module")
+def peaks() -> dict[int, float]:
+    """Peak memory (MiB, tracemalloc) of the sync of one account per length of history (years)"""
+    return {years: asyncio.run(sync_peak(years)) for years in YEARS}
+
+
+@pytest.mark.parametrize("years", YEARS)
+def test_peak_memory_stays_under_the_ceiling(peaks, years):
+    assert peaks[years] <= CEILING_MIB
+
+
+def test_peak_memory_does_not_grow_with_the_history(peaks):
+    assert peaks[YEARS[-1]] <= peaks[YEARS[0]] * GROWTH_FACTOR
@@ -0,0 +1,115 @@
+import asyncio
+
+from aiohttp import ClientConnectionError
+import pytest
+
+from myair_client.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+async def ok() -> str:
+    return "ok"
+
+
+async def unreachable() -> str:
+    raise ClientConnectionError("unreachable")
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker("host", failure_threshold=2, reset_seconds=60)
+    breaker.before()
+    breaker.failure()
+    breaker.before()
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker("host", failure_threshold=2, reset_seconds=60)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.before() is False
+
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = CircuitBreaker("host", failure_threshold=1, reset_seconds=0)
+    breaker.failure()
+    assert breaker.before() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_half_open_trial_success_closes():
+    breaker = CircuitBreaker("host", failure_threshold=1, reset_seconds=0)
+    breaker.failure()
+    breaker.before()
+    breaker.success()
+    assert breaker.before() is False
+    assert breaker.before() is False
+
+
+def test_half_open_trial_failure_opens_again():
+    breaker = CircuitBreaker("host", failure_threshold=1, reset_seconds=60)
+    breaker.failure()
+    breaker._opened_at -= 60
+    breaker.before()
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+
+def test_run_retries_transient_failures():
+    policy = RetryPolicy(attempts=3, base_delay=0)
+    calls = []
+
+    async def flaky() -> str:
+        calls.append(None)
+        if len(calls) < 3:
+            raise ClientConnectionError("reset")
+        return "ok"
+
+    assert asyncio.run(policy.run("step", "host", policy.breaker("account"), flaky)) == "ok"
+    assert len(calls) == 3
+
+
+def test_run_does_not_retry_fatal_failures():
+    policy = RetryPolicy(attempts=3, base_delay=0)
+    calls = []
+
+    async def fatal() -> str:
+        calls.append(None)
+        raise ValueError("unexpected payload")
+
+    with pytest.raises(ValueError):
+        asyncio.run(policy.run("step", "host", policy.breaker("account"), fatal))
+    assert len(calls) == 1
+
+
+def test_cancelled_trial_does_not_keep_the_breakers_open():
+    policy = RetryPolicy(attempts=1, failure_threshold=1, reset_seconds=0)
+    account_breaker = policy.breaker("account")
+
+    async def scenario() -> None:
+        with pytest.raises(ClientConnectionError):
+            await policy.run("step", "host", account_breaker, unreachable)
+
+        started = asyncio.Event()
+
+        async def hang() -> str:
+            started.set()
+            await asyncio.sleep(3600)
+            return "late"
+
+        trial = asyncio.create_task(policy.run("step", "host", account_breaker, hang))
+        await started.wait()
+        with pytest.raises(CircuitOpenError):
+            await policy.run("step", "host", account_breaker, ok)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        assert await policy.run("step", "host", account_breaker, ok) == "ok"
+        assert await policy.run("step", "host", account_breaker, ok) == "ok"
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+from datetime import datetime, timezone
+import time
+
+import pytest
+
+from scheduler import JITTER, MAX_BACKOFF_SECONDS, MIN_SPREAD_MINUTES, PollScheduler, _AccountSchedule, upload_window
+from state import StateStore
+
+MIN_INTERVAL = 300
+MAX_INTERVAL = 3600
+# Uploads around 07:00 UTC
+UPLOADS = ["2026-10-14T06:50:00Z", "2026-10-15T07:00:00Z", "2026-10-16T07:10:00Z"]
+
+
+def at(hour: int, minute: int = 0, day: int = 17) -> datetime:
+    return datetime(2026, 10, day, hour, minute, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def scheduler() -> PollScheduler:
+    return PollScheduler(StateStore(None), MIN_INTERVAL, MAX_INTERVAL)
+
+
+def test_upload_window_wraps_around_midnight():
+    center, spread = upload_window([23 * 60 + 50, 10])
+    assert center == 0
+    assert spread == MIN_SPREAD_MINUTES
+
+
+def test_accounts_without_history_are_polled_every_max_interval(scheduler):
+    assert scheduler.interval(_AccountSchedule(UPLOADS[:2]), at(7)) == MAX_INTERVAL
+
+
+def test_polls_are_dense_in_the_upload_window(scheduler):
+    assert scheduler.interval(_AccountSchedule(UPLOADS), at(7, 20)) == MIN_INTERVAL
+
+
+def test_waits_for_the_window_until_the_night_is_imported(scheduler):
+    # Night not imported yet, window opens at 06:30
+    assert scheduler.interval(_AccountSchedule(UPLOADS), at(6, 10)) == 20 * 60
+    assert scheduler.interval(_AccountSchedule(UPLOADS), at(2, day=18)) == MAX_INTERVAL
+
+
+def test_backs_off_once_the_night_is_imported(scheduler):
+    account = _AccountSchedule(UPLOADS + ["2026-10-17T07:00:00Z"])
+    intervals = []
+    for idle_polls in range(12):
+        account.idle_polls = idle_polls
+        intervals.append(scheduler.interval(account, at(8)))
+    assert intervals[0] == MIN_INTERVAL
+    assert intervals == sorted(intervals)
+    assert max(intervals) <= MAX_BACKOFF_SECONDS
+    # Never past the opening of the next window (06:30 tomorrow)
+    account.idle_polls = 20
+    assert scheduler.interval(account, at(2, day=18)) == 4.5 * 3600
+
+
+def test_done_learns_uploads_and_schedules_the_next_poll():
+    store = StateStore(None)
+    scheduler = PollScheduler(store, MIN_INTERVAL, MAX_INTERVAL)
+    scheduler.start(["account"])
+    # First polls are spread over min_interval
+    assert scheduler.due(time.time() + MIN_INTERVAL) == ["account"]
+
+    now = at(7, 20).timestamp()
+
+    for upload in UPLOADS:
+        scheduler.done("account", upload, ok=True, now=now)
+    assert store.get_uploads("account", PollScheduler.HISTORY) == UPLOADS
+    # Nothing new since the last upload (yesterday): still in the window
+    wait = scheduler.done("account", UPLOADS[-1], ok=True, now=now)
+    assert MIN_INTERVAL * (1 - JITTER) <= wait <= MIN_INTERVAL * (1 + JITTER)
+    assert scheduler.due(now) == []
+    assert scheduler.next_poll() == pytest.approx(now + wait)
+
+
+def test_failed_polls_wait_max_interval(scheduler):
+    scheduler.start(["account"])
+    wait = scheduler.done("account", None, ok=False, now=at(7).timestamp())
+    assert MAX_INTERVAL * (1 - JITTER) <= wait <= MAX_INTERVAL * (1 + JITTER)
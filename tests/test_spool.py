@@ -0,0 +1,108 @@
+import asyncio
+
+from influx import InfluxWriter
+from spool import Spool
+
+
+class FakeConnector:
+    """The parts of an InfluxConnector used by InfluxWriter"""
+
+    bucket = "bucket"
+    write_key = ("url", "org", "token", "bucket")
+    spool_key = "0123456789abcdef"
+
+    def __init__(self, failures: int = 0) -> None:
+        self.written: list[bytes] = []
+        self._failures: int = failures
+
+    def add_samples(self, lines: list[bytes]) -> None:
+        if self._failures:
+            self._failures -= 1
+            raise ConnectionError("influx is down")
+        self.written.extend(lines)
+
+
+def test_append_seal_read_remove(tmp_path):
+    spool = Spool(tmp_path, 1024 * 1024)
+    spool.append("key", [b"m f=1i 1", b"m f=2i 2"])
+    assert spool.has_pending("key")
+    assert spool.segments("key") == []
+
+    spool.seal()
+    (segment,) = spool.segments("key")
+    assert spool.read(segment) == [b"m f=1i 1", b"m f=2i 2"]
+    spool.remove(segment)
+    assert not spool.has_pending("key")
+    assert spool.size == 0
+
+
+def test_open_segments_survive_a_restart(tmp_path):
+    Spool(tmp_path, 1024 * 1024).append("key", [b"m f=1i 1"])
+    spool = Spool(tmp_path, 1024 * 1024)
+    (segment,) = spool.segments("key")
+    assert spool.read(segment) == [b"m f=1i 1"]
+    assert spool.size == segment.stat().st_size
+
+
+def test_torn_lines_are_skipped(tmp_path):
+    spool = Spool(tmp_path, 1024 * 1024)
+    spool.append("key", [b"m f=1i 1", b"m f=2i 2"])
+    spool.seal()
+    (segment,) = spool.segments("key")
+    data = segment.read_bytes()
+    segment.write_bytes(data.replace(b"f=1i", b"f=9i") + data[:5])
+    assert spool.read(segment) == [b"m f=2i 2"]
+
+
+def test_oldest_segments_are_evicted(tmp_path):
+    line = b"m f=1i 1"
+    spool = Spool(tmp_path, 1024 * 1024)
+    spool.append("a", [line])
+    segment_bytes = spool.size
+    spool = Spool(tmp_path, 2 * segment_bytes)
+
+    spool.seal()
+    spool.append("b", [line])
+    spool.seal()
+    spool.append("a", [line])
+    spool.seal()
+    remaining = [path.parent.name for key in spool.keys() for path in spool.segments(key)]
+    assert sorted(remaining) == ["a", "b"]
+    assert spool.size == 2 * segment_bytes
+    # The one from the first append is gone
+    assert all(int(path.stem) > 1 for key in spool.keys() for path in spool.segments(key))
+
+
+def test_writer_drains_the_spool_into_influx(tmp_path):
+    async def scenario() -> None:
+        spool = Spool(tmp_path, 1024 * 1024)
+        writer = InfluxWriter(2, 60, 2, spool=spool)
+        connector = FakeConnector()
+        await writer.write(connector, [b"m f=1i 1", b"m f=2i 2", b"m f=3i 3"])
+        assert writer.has_backlog(connector)
+        await writer.close()
+        assert connector.written == [b"m f=1i 1", b"m f=2i 2", b"m f=3i 3"]
+        assert not writer.has_backlog(connector)
+        assert spool.size == 0
+
+    asyncio.run(scenario())
+
+
+def test_points_stay_spooled_while_influx_is_down(tmp_path):
+    async def scenario() -> None:
+        writer = InfluxWriter(10, 60, 2, max_retries=0, spool=Spool(tmp_path, 1024 * 1024))
+        down = FakeConnector(failures=1)
+        await writer.write(down, [b"m f=1i 1"])
+        await writer.close()
+        assert down.written == []
+        assert writer.has_backlog(down)
+
+        # Next run: written once a connector for the bucket is registered
+        writer = InfluxWriter(10, 60, 2, spool=Spool(tmp_path, 1024 * 1024))
+        up = FakeConnector()
+        writer.register(up)
+        await writer.close()
+        assert up.written == [b"m f=1i 1"]
+        assert not writer.has_backlog(up)
+
+    asyncio.run(scenario())
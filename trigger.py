@@ -0,0 +1,45 @@
+import hmac
+import logging
+
+from aiohttp import web
+
+from fleet import Fleet
+
+
+class TriggerServer:
+    """
+    Small HTTP endpoint to sync right away instead of waiting for the next scheduled poll:
+    POST /sync syncs every account, POST /sync/<account name> a single one.
+    Runs alongside the scheduled loop; a trigger for an account that is already syncing joins that sync.
+    """
+
+    def __init__(self, fleet: Fleet, host: str, port: int, token: str | None = None) -> None:
+        self._fleet = fleet
+        self._host: str = host
+        self._port: int = port
+        self._token: str | None = token
+        self._runner: web.AppRunner | None = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.add_routes([web.post("/sync", self.__sync), web.post("/sync/{account}", self.__sync)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        logging.info(f"Listening for sync triggers on http://{self._host}:{self._port}/sync")
+
+    async def close(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __sync(self, request: web.Request) -> web.Response:
+        if self._token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {self._token}"):
+            raise web.HTTPUnauthorized()
+        name = request.match_info.get("account")
+        accounts = [a for a in self._fleet.accounts if name is None or a.name == name]
+        if not accounts:
+            raise web.HTTPNotFound(text=f"No account named {name}")
+        logging.info(f"Sync triggered for {name or 'all accounts'}.")
+        stats = await self._fleet.sync_all(accounts)
+        return web.json_response([s._asdict() for s in stats], status=200 if all(s.ok for s in stats) else 502)